@@ -1,22 +1,63 @@
 from flask import Flask, request, render_template, send_file, flash, redirect, url_for
-import PyPDF2
 import pdfplumber
+import pypdfium2 as pdfium
 import os
 import re
+import logging
 from openpyxl import load_workbook
-import tempfile
+from openpyxl.utils.cell import get_column_letter, column_index_from_string, coordinate_from_string
+from lxml import etree
 import io
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from excel_to_image import excel_to_image_with_cropping
 
+# Use google-re2 (linear-time DFA) for the room scan when it is installed
+try:
+    import re2 as _room_re
+except ImportError:
+    _room_re = re
+
+# Look for room numbers in format like 0211, 0214, 1011, etc.
+# Only 3-4 digit numbers in the 100-9999 range match (no "00" prefix)
+ROOM_RE = _room_re.compile(r'\b(?:0?[1-9]\d{2}|[1-9]\d{3})\b')
+
+# SpreadsheetML namespaces used when stamping the template XML directly
+SHEET_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'
-app.config['UPLOAD_FOLDER'] = 'uploads'
+# Generated reports stay on disk; the uploaded PDFs are only needed while the
+# request runs, so they go to a per-request temp dir (on tmpfs when available)
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_DIR', 'uploads')
+TEMP_UPLOAD_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+UPLOAD_BUFFER_SIZE = 1 << 20  # 1MB copy chunks when saving uploads
+
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# One worker pool for all requests, created on first use so each gunicorn
+# worker (or run.py) gets its own after the fork instead of one per PDF
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool():
+    """Return the shared process pool for PDF page extraction"""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) - 1))
+        return _POOL
+
 def get_pdf_crop_boundaries(pdf_path):
     """Determine crop boundaries for the first column based on file type"""
     filename = os.path.basename(pdf_path).lower()
@@ -32,140 +73,311 @@ def get_pdf_crop_boundaries(pdf_path):
         # Default - try to detect automatically
         return {'x0': 0, 'x1': 220}  # Conservative default
 
-def extract_room_numbers_from_pdf(pdf_path):
-    """Extract room numbers from PDF file using first column cropping"""
-    room_numbers = set()
+def _extract_page_rooms(pdf_path, page_index, crop):
+    """Extract room numbers from the first column of a single PDF page"""
+    rooms = set()
     
-    # Get crop boundaries for this PDF type
-    crop = get_pdf_crop_boundaries(pdf_path)
-    print(f"Using crop boundaries for {os.path.basename(pdf_path)}: x={crop['x0']}-{crop['x1']}")
+    with pdfium.PdfDocument(pdf_path) as pdf:
+        page = pdf[page_index]
+        # Extract text from the first column only (pdfium character
+        # boxes, no layout analysis)
+        textpage = page.get_textpage()
+        text = textpage.get_text_bounded(left=crop['x0'], bottom=0,
+                                         right=crop['x1'], top=page.get_height())
+        textpage.close()
+        page.close()
     
+    if text:
+        logger.debug("Page %d cropped text preview: %s...", page_index + 1, text[:100])
+        
+        matches = ROOM_RE.findall(text)
+        
+        logger.debug("Found potential room numbers: %s...", matches[:10])
+        
+        # ROOM_RE only matches valid room numbers; int() drops leading zeros (0211 -> 211)
+        for match in matches:
+            rooms.add(int(match))
+    
+    return rooms
+
+def _count_pages(pdf_path):
+    """Number of pages in a PDF (runs in a pool worker like the page extraction)"""
+    with pdfium.PdfDocument(pdf_path) as pdf:
+        return len(pdf)
+
+def _extract_rooms_with_pdfplumber(pdf_path, crop):
+    """Fallback room extraction with pdfplumber when pdfium cannot read the file"""
+    room_numbers = set()
     try:
+        print("Falling back to pdfplumber word extraction...")
         with pdfplumber.open(pdf_path) as pdf:
-            for page_num, page in enumerate(pdf.pages, 1):
-                # Crop page to only the first column
-                cropped_page = page.crop((crop['x0'], 0, crop['x1'], page.height))
-                
-                # Extract text from cropped area only
-                text = cropped_page.extract_text()
+            for page in pdf.pages:
+                # extract_words skips extract_text's line reconstruction;
+                # keep only words starting in the first column
+                words = page.extract_words(x_tolerance=1, y_tolerance=3, keep_blank_chars=False)
+                text = ' '.join(w['text'] for w in words if w['x0'] < crop['x1'])
                 if text:
-                    print(f"Page {page_num} cropped text preview: {text[:100]}...")
-                    
-                    # Look for room numbers in format like 0211, 0214, 1011, etc.
-                    # Use 3-4 digit pattern to catch both formats
-                    room_pattern = r'\b(\d{3,4})\b'
-                    matches = re.findall(room_pattern, text)
+                    matches = ROOM_RE.findall(text)
                     
-                    print(f"Found potential room numbers: {matches[:10]}...")
-                    
-                    # Filter to keep only valid room numbers
                     for match in matches:
-                        if len(match) >= 3 and match.isdigit():
-                            # Convert to format like 211, 214 (remove leading zero if exists)
-                            room_num = match.lstrip('0') if match.startswith('0') else match
-                            if room_num and len(room_num) >= 3:  # Valid room numbers should be at least 3 digits
-                                room_int = int(room_num)
-                                # More lenient filtering since we're only looking at first column
-                                if 100 <= room_int <= 9999:
-                                    room_numbers.add(room_int)
-                                    
-    except Exception as e:
-        print(f"Error extracting from PDF {pdf_path}: {str(e)}")
-        # Fallback to old method if cropping fails
+                        room_int = int(match)
+                        if not (2500 <= room_int <= 2600):
+                            room_numbers.add(room_int)
+    except Exception as e2:
+        print(f"Fallback extraction also failed: {str(e2)}")
+    return room_numbers
+
+def extract_room_numbers_from_pdfs(pdf_paths):
+    """Extract room numbers from several PDFs using first column cropping, one set per PDF"""
+    # Every page of every file goes to the shared worker pool - PDFium is not
+    # thread-safe, so request threads never open a document themselves
+    pool = get_pool()
+    crops = [get_pdf_crop_boundaries(pdf_path) for pdf_path in pdf_paths]
+    for pdf_path, crop in zip(pdf_paths, crops):
+        print(f"Using crop boundaries for {os.path.basename(pdf_path)}: x={crop['x0']}-{crop['x1']}")
+    
+    count_futures = [pool.submit(_count_pages, pdf_path) for pdf_path in pdf_paths]
+    
+    # Queue the pages of all files before waiting on any of them
+    page_futures = []
+    for pdf_path, crop, count_future in zip(pdf_paths, crops, count_futures):
         try:
-            print("Falling back to full-text extraction...")
-            with pdfplumber.open(pdf_path) as pdf:
-                for page in pdf.pages:
-                    text = page.extract_text()
-                    if text:
-                        room_pattern = r'\b(\d{3,4})\b'
-                        matches = re.findall(room_pattern, text)
+            page_futures.append([pool.submit(_extract_page_rooms, pdf_path, page_index, crop)
+                                 for page_index in range(count_future.result())])
+        except Exception as e:
+            page_futures.append(e)
+    
+    results = []
+    for pdf_path, crop, futures in zip(pdf_paths, crops, page_futures):
+        room_numbers = set()
+        try:
+            if isinstance(futures, Exception):
+                raise futures
+            for future in futures:
+                room_numbers |= future.result()
+        except Exception as e:
+            print(f"Error extracting from PDF {pdf_path}: {str(e)}")
+            room_numbers |= _extract_rooms_with_pdfplumber(pdf_path, crop)
+        
+        print(f"Final extracted room numbers ({len(room_numbers)}): {sorted(list(room_numbers)[:10])}...")
+        results.append(room_numbers)
+    return results
+
+def extract_room_numbers_from_pdf(pdf_path):
+    """Extract room numbers from PDF file using first column cropping"""
+    return extract_room_numbers_from_pdfs([pdf_path])[0]
+
+def _scan_header_positions(ws):
+    """Find the Room/OD/DO/ARR column groups in the template header row"""
+    # Based on analysis, headers are in row 4, room data starts from row 5
+    header_row = 4
+    
+    # Find header columns for each section
+    header_positions = []
+    for col in range(1, ws.max_column + 1):
+        header_cell = ws.cell(row=header_row, column=col)
+        if header_cell.value:
+            header_val = str(header_cell.value).strip()
+            if header_val == 'Room':
+                # Found a room column, next columns should be OD, DO, ARR, NOTE
+                room_col = col
+                od_col = col + 1 if col + 1 <= ws.max_column else None
+                do_col = col + 2 if col + 2 <= ws.max_column else None
+                arr_col = col + 3 if col + 3 <= ws.max_column else None
+                
+                # Verify column headers (exact match - 'DO' must not match e.g. 'DOOR')
+                od_header = ws.cell(row=header_row, column=od_col).value if od_col else None
+                do_header = ws.cell(row=header_row, column=do_col).value if do_col else None
+                arr_header = ws.cell(row=header_row, column=arr_col).value if arr_col else None
+                
+                od_value = str(od_header).strip().upper() if od_header else ''
+                do_value = str(do_header).strip().upper() if do_header else ''
+                arr_value = str(arr_header).strip().upper() if arr_header else ''
+                
+                if od_value == 'OD' and do_value == 'DO' and arr_value == 'ARR':
+                    
+                    header_positions.append({
+                        'room_col': room_col,
+                        'od_col': od_col,
+                        'do_col': do_col,
+                        'arr_col': arr_col
+                    })
+    
+    return header_positions
+
+def _scan_room_cells(ws, header_positions):
+    """List each room number in the template with its OD/DO/ARR cell references"""
+    room_cells = []
+    
+    # Process each row starting from row 5
+    for row in ws.iter_rows(min_row=5, max_row=ws.max_row):
+        for section in header_positions:
+            room_cell = row[section['room_col'] - 1]
+            if room_cell.value:
+                try:
+                    room_value = str(room_cell.value).strip()
+                    if room_value.isdigit():
+                        # int() handles formats like 0211 -> 211
+                        room_num = int(room_value)
+                        row_num = room_cell.row
                         
-                        for match in matches:
-                            if len(match) >= 3 and match.isdigit():
-                                room_num = match.lstrip('0') if match.startswith('0') else match
-                                if room_num and len(room_num) >= 3:
-                                    room_int = int(room_num)
-                                    if 100 <= room_int <= 9999 and not (2500 <= room_int <= 2600):
-                                        room_numbers.add(room_int)
-        except Exception as e2:
-            print(f"Fallback extraction also failed: {str(e2)}")
+                        od_ref = f"{get_column_letter(section['od_col'])}{row_num}" if section['od_col'] else None
+                        do_ref = f"{get_column_letter(section['do_col'])}{row_num}" if section['do_col'] else None
+                        arr_ref = f"{get_column_letter(section['arr_col'])}{row_num}" if section['arr_col'] else None
+                        room_cells.append((room_num, od_ref, do_ref, arr_ref))
+                except ValueError:
+                    continue  # Skip non-numeric room values
     
-    print(f"Final extracted room numbers ({len(room_numbers)}): {sorted(list(room_numbers)[:10])}...")
-    return room_numbers
+    return room_cells
+
+def _active_sheet_part(xlsx):
+    """Return the zip member name of the workbook's active worksheet"""
+    workbook = etree.fromstring(xlsx.read('xl/workbook.xml'))
+    view = workbook.find(f'{{{SHEET_NS}}}bookViews/{{{SHEET_NS}}}workbookView')
+    active_tab = int(view.get('activeTab', 0)) if view is not None else 0
+    sheet = workbook.findall(f'{{{SHEET_NS}}}sheets/{{{SHEET_NS}}}sheet')[active_tab]
+    rel_id = sheet.get(f'{{{REL_NS}}}id')
+    
+    rels = etree.fromstring(xlsx.read('xl/_rels/workbook.xml.rels'))
+    for rel in rels:
+        if rel.get('Id') == rel_id:
+            target = rel.get('Target')
+            return target[1:] if target.startswith('/') else 'xl/' + target
+    raise KeyError(f"Worksheet relationship {rel_id} not found")
+
+def _set_inline_string(cell, value):
+    """Replace a <c> element's content with an inline string value"""
+    for child in list(cell):
+        cell.remove(child)
+    cell.set('t', 'inlineStr')
+    inline = etree.SubElement(cell, f'{{{SHEET_NS}}}is')
+    etree.SubElement(inline, f'{{{SHEET_NS}}}t').text = value
+
+def _stamp_sheet_xml(sheet_xml, marks, value='x'):
+    """Write value into every cell reference in marks, keeping the rest of the sheet XML as is"""
+    root = etree.fromstring(sheet_xml)
+    sheet_data = root.find(f'{{{SHEET_NS}}}sheetData')
+    pending = set(marks)
+    
+    # Marks are stamped in one document-order pass; stop as soon as all are placed
+    rows = {}
+    for row in sheet_data:
+        if not pending:
+            break
+        rows[int(row.get('r'))] = row
+        for cell in row:
+            ref = cell.get('r')
+            if ref in pending:
+                _set_inline_string(cell, value)
+                pending.discard(ref)
+    
+    # Cells the template does not define yet - insert them in column order
+    for ref in pending:
+        col_letters, row_num = coordinate_from_string(ref)
+        col_idx = column_index_from_string(col_letters)
+        
+        row = rows.get(row_num)
+        if row is None:
+            row = etree.Element(f'{{{SHEET_NS}}}row', r=str(row_num))
+            following = [r for r in sheet_data if int(r.get('r')) > row_num]
+            if following:
+                following[0].addprevious(row)
+            else:
+                sheet_data.append(row)
+            rows[row_num] = row
+        
+        cell = etree.Element(f'{{{SHEET_NS}}}c', r=ref)
+        following = [c for c in row
+                     if column_index_from_string(coordinate_from_string(c.get('r'))[0]) > col_idx]
+        if following:
+            following[0].addprevious(cell)
+        else:
+            row.append(cell)
+        _set_inline_string(cell, value)
+    
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)
+
+def _write_marked_workbook(template_bytes, marks, output_path):
+    """Copy the template xlsx to output_path, stamping marks into the active sheet XML only"""
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as xlsx:
+        sheet_part = _active_sheet_part(xlsx)
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as out:
+            for item in xlsx.infolist():
+                data = xlsx.read(item.filename)
+                if item.filename == sheet_part:
+                    data = _stamp_sheet_xml(data, marks)
+                out.writestr(item, data)
+
+# Read the Excel template once at startup; requests stamp their marks
+# straight into a copy of these bytes
+TEMPLATE_PATH = 'template.xlsx'
+TEMPLATE_BYTES = None
+if os.path.exists(TEMPLATE_PATH):
+    with open(TEMPLATE_PATH, 'rb') as f:
+        TEMPLATE_BYTES = f.read()
+
+# The template layout never changes, so locate its room cells only once
+TEMPLATE_ROOM_CELLS = None
+if TEMPLATE_BYTES is not None:
+    _template_ws = load_workbook(io.BytesIO(TEMPLATE_BYTES)).active
+    TEMPLATE_ROOM_CELLS = _scan_room_cells(_template_ws, _scan_header_positions(_template_ws))
+    del _template_ws
 
 def update_excel_template(template_path, arr_rooms, dep_rooms, gih_rooms, output_path):
     """Update Excel template with room data"""
     try:
-        wb = load_workbook(template_path)
-        ws = wb.active
+        if template_path == TEMPLATE_PATH and TEMPLATE_ROOM_CELLS is not None:
+            template_bytes = TEMPLATE_BYTES
+            room_cells = TEMPLATE_ROOM_CELLS
+        else:
+            with open(template_path, 'rb') as f:
+                template_bytes = f.read()
+            ws = load_workbook(io.BytesIO(template_bytes)).active
+            room_cells = _scan_room_cells(ws, _scan_header_positions(ws))
         
         print(f"Processing rooms:")
         print(f"ARR: {sorted(arr_rooms)}")
         print(f"DEP: {sorted(dep_rooms)}")
         print(f"GIH: {sorted(gih_rooms)}")
         
-        # Based on analysis, headers are in row 4, room data starts from row 5
-        header_row = 4
-        
-        # Find header columns for each section
-        header_positions = []
-        for col in range(1, ws.max_column + 1):
-            header_cell = ws.cell(row=header_row, column=col)
-            if header_cell.value:
-                header_val = str(header_cell.value).strip()
-                if header_val == 'Room':
-                    # Found a room column, next columns should be OD, DO, ARR, NOTE
-                    room_col = col
-                    od_col = col + 1 if col + 1 <= ws.max_column else None
-                    do_col = col + 2 if col + 2 <= ws.max_column else None
-                    arr_col = col + 3 if col + 3 <= ws.max_column else None
-                    
-                    # Verify column headers
-                    od_header = ws.cell(row=header_row, column=od_col).value if od_col else None
-                    do_header = ws.cell(row=header_row, column=do_col).value if do_col else None
-                    arr_header = ws.cell(row=header_row, column=arr_col).value if arr_col else None
-                    
-                    if (od_header and 'OD' in str(od_header) and 
-                        do_header and 'DO' in str(do_header) and 
-                        arr_header and 'ARR' in str(arr_header)):
-                        
-                        header_positions.append({
-                            'room_col': room_col,
-                            'od_col': od_col,
-                            'do_col': do_col,
-                            'arr_col': arr_col
-                        })
-        
-        print(f"Found {len(header_positions)} room sections")
-        
-        # Process each row starting from row 5
-        for row_num in range(5, ws.max_row + 1):
-            for section in header_positions:
-                room_cell = ws.cell(row=row_num, column=section['room_col'])
-                if room_cell.value:
-                    try:
-                        room_value = str(room_cell.value).strip()
-                        if room_value.isdigit():
-                            # Convert room number (handle formats like 0211 -> 211)
-                            room_num = int(room_value.lstrip('0')) if room_value.startswith('0') else int(room_value)
-                            
-                            # Mark appropriate columns
-                            if room_num in gih_rooms and section['od_col']:
-                                ws.cell(row=row_num, column=section['od_col'], value='x')
-                                print(f"Marked room {room_num} in OD column")
-                            
-                            if room_num in dep_rooms and section['do_col']:
-                                ws.cell(row=row_num, column=section['do_col'], value='x')
-                                print(f"Marked room {room_num} in DO column")
-                            
-                            if room_num in arr_rooms and section['arr_col']:
-                                ws.cell(row=row_num, column=section['arr_col'], value='x')
-                                print(f"Marked room {room_num} in ARR column")
-                    except ValueError:
-                        continue  # Skip non-numeric room values
-        
-        wb.save(output_path)
+        print(f"Found {len(room_cells)} room cells")
+        
+        # One lookup per room cell: bit 1 = OD (GIH), 2 = DO (DEP), 4 = ARR
+        flags = {}
+        for room in gih_rooms:
+            flags[room] = flags.get(room, 0) | 1
+        for room in dep_rooms:
+            flags[room] = flags.get(room, 0) | 2
+        for room in arr_rooms:
+            flags[room] = flags.get(room, 0) | 4
+        
+        # Collect the cells to mark, stopping once every room has been placed
+        marks = []
+        remaining = set(flags)
+        for room_num, od_ref, do_ref, arr_ref in room_cells:
+            if not remaining:
+                break
+            
+            room_flags = flags.get(room_num, 0)
+            if not room_flags:
+                continue
+            remaining.discard(room_num)
+            
+            if room_flags & 1 and od_ref:
+                marks.append(od_ref)
+                logger.debug("Marked room %d in OD column", room_num)
+            
+            if room_flags & 2 and do_ref:
+                marks.append(do_ref)
+                logger.debug("Marked room %d in DO column", room_num)
+            
+            if room_flags & 4 and arr_ref:
+                marks.append(arr_ref)
+                logger.debug("Marked room %d in ARR column", room_num)
+        
+        print(f"Marked {len(marks)} cells")
+        
+        _write_marked_workbook(template_bytes, marks, output_path)
         print(f"Excel file saved to: {output_path}")
         return True
     except Exception as e:
@@ -198,27 +410,29 @@ def process_files():
         # Check output format
         output_format = request.form.get('output_format', 'excel')
         
-        # Save uploaded files
+        # Save uploaded files - fixed arr/dep/gih names, the crop is chosen from the file name
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        arr_path = os.path.join(app.config['UPLOAD_FOLDER'], f'arr_{timestamp}.pdf')
-        dep_path = os.path.join(app.config['UPLOAD_FOLDER'], f'dep_{timestamp}.pdf')
-        gih_path = os.path.join(app.config['UPLOAD_FOLDER'], f'gih_{timestamp}.pdf')
-        
-        arr_file.save(arr_path)
-        dep_file.save(dep_path)
-        gih_file.save(gih_path)
-        
-        # Extract room numbers from each PDF
-        arr_rooms = extract_room_numbers_from_pdf(arr_path)
-        dep_rooms = extract_room_numbers_from_pdf(dep_path)
-        gih_rooms = extract_room_numbers_from_pdf(gih_path)
+        input_dir = tempfile.mkdtemp(prefix='process_', dir=TEMP_UPLOAD_DIR)
+        try:
+            arr_path = os.path.join(input_dir, 'arr.pdf')
+            dep_path = os.path.join(input_dir, 'dep.pdf')
+            gih_path = os.path.join(input_dir, 'gih.pdf')
+            
+            arr_file.save(arr_path, buffer_size=UPLOAD_BUFFER_SIZE)
+            dep_file.save(dep_path, buffer_size=UPLOAD_BUFFER_SIZE)
+            gih_file.save(gih_path, buffer_size=UPLOAD_BUFFER_SIZE)
+            
+            # Extract room numbers from the three PDFs together - their pages share one worker pool
+            arr_rooms, dep_rooms, gih_rooms = extract_room_numbers_from_pdfs((arr_path, dep_path, gih_path))
+        finally:
+            shutil.rmtree(input_dir, ignore_errors=True)
         
         print(f"ARR rooms: {arr_rooms}")
         print(f"DEP rooms: {dep_rooms}")
         print(f"GIH rooms: {gih_rooms}")
         
         # Update Excel template
-        template_path = 'template.xlsx'
+        template_path = TEMPLATE_PATH
         output_excel_path = os.path.join(app.config['UPLOAD_FOLDER'], f'result_{timestamp}.xlsx')
         
         success = update_excel_template(template_path, arr_rooms, dep_rooms, gih_rooms, output_excel_path)
@@ -4,11 +4,85 @@ ComPDF API integration for Excel to PDF conversion
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import traceback
 import time
 
-def convert_excel_to_pdf(excel_path):
-    """Convert Excel to PDF using ComPDF API"""
+# One pooled keep-alive session for all ComPDF calls, so task creation,
+# upload, execute and polling reuse the same TLS connection
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+def _poll_compdf(file_key, headers, pdf_path, max_attempts=30, max_delay=10.0):
+    """Poll ComPDF conversion status and download the PDF to pdf_path when finished"""
+    # Exponential backoff: 1s, 2s, 4s, 8s, then max_delay (or Retry-After)
+    status_url = "https://api-server.compdf.com/server/v1/file/fileInfo"
+    delay = 1.0
+    
+    for attempt in range(max_attempts):
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+        
+        print(f"Checking status... (attempt {attempt + 1}/{max_attempts})")
+        
+        # Check file info to get status
+        full_status_url = f"{status_url}?fileKey={file_key}&language=english"
+        status_response = _SESSION.get(full_status_url, headers=headers, timeout=30)
+        
+        # Retry-After in seconds only (an HTTP-date is ignored), never longer than max_delay
+        retry_after = status_response.headers.get('Retry-After', '').strip()
+        if retry_after.isdigit():
+            delay = min(float(retry_after), max_delay)
+        
+        if status_response.status_code != 200:
+            print(f"Failed to check status: {status_response.text}")
+            continue
+            
+        status_result = status_response.json()
+        if status_result.get('code') != 200:
+            print(f"Status check failed: {status_result}")
+            continue
+            
+        status_data = status_result.get('data', {})
+        task_status = status_data.get('status')
+        print(f"Task status: {task_status}")
+        
+        if task_status == 'TaskFinish':
+            # Download the converted PDF
+            download_url = status_data.get('downloadUrl')
+            if not download_url:
+                print("No download URL found")
+                return None
+                
+            print(f"Downloading PDF from: {download_url}")
+            
+            # Stream to disk in 1MB chunks instead of holding the PDF in memory
+            with _SESSION.get(download_url, stream=True, timeout=60) as download_response:
+                if download_response.status_code != 200:
+                    print(f"Failed to download PDF: {download_response.text}")
+                    return None
+                
+                with open(pdf_path, 'wb') as f:
+                    for chunk in download_response.iter_content(chunk_size=1 << 20):
+                        f.write(chunk)
+            
+            return pdf_path
+                
+        elif task_status in ['TaskFail', 'TaskError']:
+            failure_reason = status_data.get('failureReason', 'Unknown error')
+            failure_code = status_data.get('failureCode', 'Unknown code')
+            print(f"Task failed: Code={failure_code}, Reason={failure_reason}")
+            return None
+            
+    print("Timeout waiting for conversion to complete")
+    return None
+
+
+def convert_excel_to_pdf(excel_path, pdf_path=None):
+    """Convert Excel to PDF using ComPDF API, returns the path of the downloaded PDF"""
+    if pdf_path is None:
+        pdf_path = os.path.splitext(excel_path)[0] + '.pdf'
+    
     # ComPDF API credentials from environment variables
     PUBLIC_KEY = os.environ.get('COMPDF_PUBLIC_KEY')
     SECRET_KEY = os.environ.get('COMPDF_SECRET_KEY')
@@ -26,7 +100,7 @@ def convert_excel_to_pdf(excel_path):
         }
         
         print("Getting available PDF tools...")
-        tools_response = requests.get(tools_url, headers=tools_headers, timeout=30)
+        tools_response = _SESSION.get(tools_url, headers=tools_headers, timeout=30)
         
         if tools_response.status_code != 200:
             print(f"Failed to get tools: {tools_response.text}")
@@ -67,7 +141,7 @@ def convert_excel_to_pdf(excel_path):
         }
         
         print("Creating ComPDF conversion task...")
-        create_response = requests.post(create_task_url, headers=create_headers, json=create_payload, timeout=30)
+        create_response = _SESSION.post(create_task_url, headers=create_headers, json=create_payload, timeout=30)
         
         if create_response.status_code != 200:
             print(f"Failed to create task: {create_response.text}")
@@ -97,7 +171,7 @@ def convert_excel_to_pdf(excel_path):
             }
             
             print("Uploading Excel file...")
-            upload_response = requests.post(upload_url, headers=upload_headers, files=files, data=upload_data, timeout=60)
+            upload_response = _SESSION.post(upload_url, headers=upload_headers, files=files, data=upload_data, timeout=60)
         
         if upload_response.status_code != 200:
             print(f"Failed to upload file: {upload_response.text}")
@@ -124,7 +198,7 @@ def convert_excel_to_pdf(excel_path):
         }
         
         print("Starting conversion...")
-        execute_response = requests.post(execute_url, headers=execute_headers, json=execute_payload, timeout=30)
+        execute_response = _SESSION.post(execute_url, headers=execute_headers, json=execute_payload, timeout=30)
         
         if execute_response.status_code != 200:
             print(f"Failed to execute conversion: {execute_response.text}")
@@ -138,57 +212,7 @@ def convert_excel_to_pdf(excel_path):
         print("Conversion started, waiting for completion...")
         
         # Step 5: Check status and download
-        max_attempts = 30  # Wait up to 5 minutes
-        for attempt in range(max_attempts):
-            time.sleep(10)  # Wait 10 seconds between checks
-            
-            print(f"Checking status... (attempt {attempt + 1}/{max_attempts})")
-            
-            # Check file info to get status
-            status_url = f"https://api-server.compdf.com/server/v1/file/fileInfo?fileKey={file_key}&language=english"
-            status_headers = {
-                "Authorization": f"Bearer {PUBLIC_KEY}"
-            }
-            
-            status_response = requests.get(status_url, headers=status_headers, timeout=30)
-            
-            if status_response.status_code != 200:
-                print(f"Failed to check status: {status_response.text}")
-                continue
-                
-            status_result = status_response.json()
-            if status_result.get('code') != 200:
-                print(f"Status check failed: {status_result}")
-                continue
-                
-            task_status = status_result['data'].get('status')
-            print(f"Task status: {task_status}")
-            
-            if task_status == 'TaskFinish':
-                # Download the converted PDF
-                download_url = status_result['data'].get('downloadUrl')
-                if not download_url:
-                    print("No download URL found")
-                    return None
-                    
-                print(f"Downloading PDF from: {download_url}")
-                
-                download_response = requests.get(download_url, timeout=60)
-                if download_response.status_code == 200:
-                    return download_response.content
-                else:
-                    print(f"Failed to download PDF: {download_response.text}")
-                    return None
-                    
-            elif task_status in ['TaskFail', 'TaskError']:
-                failure_reason = status_result['data'].get('failureReason', 'Unknown error')
-                print(f"Task failed: {failure_reason}")
-                return None
-            elif task_status == 'TaskProcessing':
-                continue  # Keep waiting
-                
-        print("Timeout waiting for conversion to complete")
-        return None
+        return _poll_compdf(file_key, {"Authorization": f"Bearer {PUBLIC_KEY}"}, pdf_path)
         
     except Exception as e:
         print(f"ComPDF API error: {e}")
@@ -196,12 +220,10 @@ def convert_excel_to_pdf(excel_path):
         return None
 
 # Alternative implementation for direct API access without tool discovery
-def convert_excel_to_pdf_direct(excel_path):
-    """Convert Excel to PDF using ComPDF API (direct method)"""
-    import requests
-    import json
-    import os
-    import time
+def convert_excel_to_pdf_direct(excel_path, pdf_path=None):
+    """Convert Excel to PDF using ComPDF API (direct method), returns the path of the downloaded PDF"""
+    if pdf_path is None:
+        pdf_path = os.path.splitext(excel_path)[0] + '.pdf'
     
     # ComPDF API credentials from environment variables
     PUBLIC_KEY = os.environ.get('COMPDF_PUBLIC_KEY')
@@ -225,7 +247,7 @@ def convert_excel_to_pdf_direct(excel_path):
         }
         
         print("Creating ComPDF conversion task...")
-        create_response = requests.post(create_task_url, headers=create_headers, json=create_payload, timeout=30)
+        create_response = _SESSION.post(create_task_url, headers=create_headers, json=create_payload, timeout=30)
         
         if create_response.status_code != 200:
             print(f"Failed to create task: {create_response.text}")
@@ -254,7 +276,7 @@ def convert_excel_to_pdf_direct(excel_path):
             }
             
             print("Uploading Excel file...")
-            upload_response = requests.post(upload_url, headers=upload_headers, files=files, data=upload_data, timeout=60)
+            upload_response = _SESSION.post(upload_url, headers=upload_headers, files=files, data=upload_data, timeout=60)
         
         if upload_response.status_code != 200:
             print(f"Failed to upload file: {upload_response.text}")
@@ -281,7 +303,7 @@ def convert_excel_to_pdf_direct(excel_path):
         }
         
         print("Starting conversion...")
-        execute_response = requests.post(execute_url, headers=execute_headers, json=execute_payload, timeout=30)
+        execute_response = _SESSION.post(execute_url, headers=execute_headers, json=execute_payload, timeout=30)
         
         if execute_response.status_code != 200:
             print(f"Failed to execute conversion: {execute_response.text}")
@@ -295,58 +317,7 @@ def convert_excel_to_pdf_direct(excel_path):
         print("Conversion started, waiting for completion...")
         
         # Step 4: Check status and download
-        status_url = f"https://api-server.compdf.com/server/v1/file/fileInfo"
-        status_headers = {
-            "Authorization": f"Bearer {PUBLIC_KEY}"
-        }
-        
-        max_attempts = 30  # Wait up to 5 minutes
-        for attempt in range(max_attempts):
-            time.sleep(10)  # Wait 10 seconds between checks
-            
-            print(f"Checking status... (attempt {attempt + 1}/{max_attempts})")
-            
-            # Check file info to get status
-            full_status_url = f"{status_url}?fileKey={file_key}&language=english"
-            status_response = requests.get(full_status_url, headers=status_headers, timeout=30)
-            
-            if status_response.status_code != 200:
-                print(f"Failed to check status: {status_response.text}")
-                continue
-                
-            status_result = status_response.json()
-            if status_result.get('code') != 200:
-                print(f"Status check failed: {status_result}")
-                continue
-                
-            status_data = status_result.get('data', {})
-            task_status = status_data.get('status')
-            print(f"Task status: {task_status}")
-            
-            if task_status == 'TaskFinish':
-                # Download the converted PDF
-                download_url = status_data.get('downloadUrl')
-                if not download_url:
-                    print("No download URL found")
-                    return None
-                    
-                print(f"Downloading PDF from: {download_url}")
-                
-                download_response = requests.get(download_url, timeout=60)
-                if download_response.status_code == 200:
-                    return download_response.content
-                else:
-                    print(f"Failed to download PDF: {download_response.text}")
-                    return None
-                    
-            elif task_status in ['TaskFail', 'TaskError']:
-                failure_reason = status_data.get('failureReason', 'Unknown error')
-                failure_code = status_data.get('failureCode', 'Unknown code')
-                print(f"Task failed: Code={failure_code}, Reason={failure_reason}")
-                return None
-                
-        print("Timeout waiting for conversion to complete")
-        return None
+        return _poll_compdf(file_key, {"Authorization": f"Bearer {PUBLIC_KEY}"}, pdf_path)
         
     except Exception as e:
         print(f"ComPDF API error: {e}")
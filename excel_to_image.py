@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
 import os
+import shutil
 import subprocess
 import tempfile
 from pdf2image import convert_from_path
 from PIL import Image
 
+# Tìm LibreOffice một lần lúc import, không phải mỗi lần convert
+SOFFICE_PATH = shutil.which('soffice') or shutil.which('libreoffice') or '/opt/homebrew/bin/soffice'
+
+# Ảnh chỉ để xem trên trình duyệt - 120 DPI đủ nét, thời gian render poppler tăng theo dpi²
+PREVIEW_DPI = int(os.environ.get('PREVIEW_DPI', 120))
+
 def excel_to_image(excel_path, image_path, sheet_name=None):
     """Convert Excel file to image via Excel → PDF → PNG"""
     try:
@@ -18,7 +25,7 @@ def excel_to_image(excel_path, image_path, sheet_name=None):
             
             # Use LibreOffice to convert Excel to PDF
             cmd = [
-                '/opt/homebrew/bin/soffice',  # LibreOffice command
+                SOFFICE_PATH,                  # LibreOffice command
                 '--headless',                  # Run without GUI
                 '--convert-to', 'pdf',         # Convert to PDF format
                 '--outdir', temp_dir,          # Output directory
@@ -45,10 +52,10 @@ def excel_to_image(excel_path, image_path, sheet_name=None):
             # Step 2: Convert PDF to PNG using pdf2image
             print(f"Converting PDF to PNG: {actual_pdf_path} → {image_path}")
             
-            # Convert PDF to images (high DPI for better quality)
+            # Convert PDF to images (preview resolution)
             images = convert_from_path(
                 actual_pdf_path,
-                dpi=200,           # High resolution
+                dpi=PREVIEW_DPI,   # Preview resolution
                 fmt='PNG',         # Output format
                 first_page=1,      # Only convert first page
                 last_page=1
@@ -67,7 +74,7 @@ def excel_to_image(excel_path, image_path, sheet_name=None):
                 image = image.convert('RGB')
             
             # Save the image
-            image.save(image_path, 'PNG', quality=95, optimize=True)
+            image.save(image_path, 'PNG', compress_level=1)
             
             print(f"Successfully created: {image_path}")
             print(f"Image dimensions: {image.size[0]}x{image.size[1]}")
@@ -116,7 +123,7 @@ def excel_to_image_with_cropping(excel_path, image_path, sheet_name=None):
             cropped = image.crop((left, top, right, bottom))
             
             # Save the cropped image
-            cropped.save(image_path, 'PNG', quality=95, optimize=True)
+            cropped.save(image_path, 'PNG', compress_level=1)
             
             print(f"Cropped image to {cropped.size[0]}x{cropped.size[1]}")
         
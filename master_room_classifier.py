@@ -7,12 +7,46 @@ Kết hợp ARR, DEP, và GIH files theo logic nghiệp vụ đúng:
 - File GIH: Xác định OD (khách ở qua đêm) + bổ sung ARR nếu có
 """
 
+import logging
 import os
 import re
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 
+# Dùng google-re2 (DFA, thời gian tuyến tính) nếu có cài, không thì dùng re
+try:
+    import re2 as _re
+except ImportError:
+    _re = re
+
+logger = logging.getLogger(__name__)
+
+# Regex dùng khi parse text - compile một lần, chạy thẳng trên bytes của
+# pdftotext (không decode cả file); chỉ decode các số phòng tìm được
+_ROOM_RE = _re.compile(rb'\b(\d{4})\b')
+_YEAR_PREFIXES = frozenset((b'19', b'20'))  # 19xx, 20xx là năm, không phải phòng
+# Groups: 1 = room, 2 = check-in, 3 = check-out
+_GIH_LINE_RE = _re.compile(
+    rb'(?m)^[^\S\n]*(\d{4})'
+    rb'.*?\b(\d{2}-\d{2}-\d{2})\b'
+    rb'.*?\b(\d{2}-\d{2}-\d{2})\b'
+)
+
+# Tên hiển thị của từng loại phòng
+_CATEGORY_NAMES_VI = {
+    'ARR': 'ARRIVAL (Khách đến)',
+    'DEP': 'DEPARTURE (Khách đi)',
+    'OD': 'OVER DAY (Khách ở qua đêm)'
+}
+_CATEGORY_NAMES_EN = {
+    'ARR': 'ARRIVAL',
+    'DEP': 'DEPARTURE',
+    'OD': 'OVER DAY'
+}
+
+
 def get_schedule_date_input():
     """Nhập ngày chia lịch từ user"""
     print("📅 NHẬP NGÀY CHIA LỊCH")
@@ -28,25 +62,49 @@ def get_schedule_date_input():
             date_input = default_date
             
         try:
-            schedule_date = datetime.strptime(date_input, "%d-%m-%y")
-            print(f"✅ Ngày chia lịch: {schedule_date.strftime('%d-%m-%y')}")
-            return schedule_date.strftime("%d-%m-%y")
+            # Parse DD-MM-YY trực tiếp thành int; datetime() chỉ để kiểm tra ngày hợp lệ
+            day, month, year = map(int, date_input.split('-'))
+            if not 0 <= year <= 99:
+                raise ValueError(date_input)
+            datetime(2000 + year, month, day)
+            schedule_date = f"{day:02d}-{month:02d}-{year:02d}"
+            print(f"✅ Ngày chia lịch: {schedule_date}")
+            return schedule_date
         except ValueError:
             print("❌ Format ngày không đúng! Vui lòng nhập theo format DD-MM-YY")
 
 
-def pdf_to_text(pdf_path):
-    """Convert PDF thành text sử dụng pdftotext"""
-    text_path = pdf_path.replace('.pdf', '.txt').replace('.PDF', '.txt')
+def _text_cache_path(pdf_path):
+    """File .txt cạnh PDF, lưu output pdftotext của lần chạy trước"""
+    return os.path.splitext(pdf_path)[0] + '.txt'
+
+
+def pdf_to_text_bytes(pdf_path):
+    """Convert PDF thành text qua pipe (stdout của pdftotext), dùng lại file .txt nếu PDF chưa đổi"""
+    text_path = _text_cache_path(pdf_path)
     
+    # Cached conversion is still valid (written after the PDF last changed) - no pdftotext run
     try:
-        cmd = ['pdftotext', '-layout', pdf_path, text_path]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        if os.path.getmtime(text_path) >= os.path.getmtime(pdf_path):
+            with open(text_path, 'rb') as f:
+                return f.read()
+    except OSError:
+        pass
+    
+    try:
+        # No -q: pdftotext's own diagnostic is what gets printed when it fails
+        cmd = ['pdftotext', '-layout', '-nopgbrk', pdf_path, '-']
+        # stdout stays bytes (parsed as-is); stderr is decoded only when reporting a failure
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
         
-        if result.returncode == 0 and os.path.exists(text_path):
-            return text_path
+        if result.returncode == 0 and result.stdout:
+            _write_text_cache(text_path, result.stdout)
+            return result.stdout
+        elif result.returncode != 0:
+            print(f"❌ pdftotext error for {pdf_path}: {result.stderr.decode('utf-8', 'replace')}")
+            return None
         else:
-            print(f"❌ pdftotext error for {pdf_path}: {result.stderr}")
+            print(f"❌ pdftotext error for {pdf_path}: no text output")
             return None
             
     except Exception as e:
@@ -54,53 +112,62 @@ def pdf_to_text(pdf_path):
         return None
 
 
+def _write_text_cache(text_path, data):
+    """Ghi cache .txt qua file tạm + os.replace; thư mục không ghi được thì bỏ qua cache"""
+    tmp_path = f'{text_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, text_path)
+    except OSError as e:
+        logger.debug("Could not cache %s: %s", text_path, e)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
 def extract_rooms_from_arr_dep(pdf_path, file_type):
     """
     Trích xuất số phòng từ file ARR/DEP
     Sử dụng crop method đã test trước đó
     """
-    print(f"📄 Processing {file_type} file: {pdf_path}")
+    logger.info("📄 Processing %s file: %s", file_type, pdf_path)
     
     # Convert to text first
-    text_path = pdf_to_text(pdf_path)
-    if not text_path:
+    return parse_rooms_from_arr_dep(pdf_to_text_bytes(pdf_path), file_type)
+
+
+def parse_rooms_from_arr_dep(content, file_type):
+    """Đọc số phòng ARR/DEP từ text (bytes) đã convert"""
+    if not content:
         return []
     
     try:
-        with open(text_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        lines = content.split('\n')
-        
         # Extract room numbers - tìm 4 digit numbers đầu dòng hoặc trong dòng
-        rooms = []
-        for line in lines:
-            line_clean = line.strip()
-            if line_clean:
-                # Tìm room numbers (4 digits)
-                room_matches = re.findall(r'\b(\d{4})\b', line_clean)
-                for room in room_matches:
-                    # Filter ra những số hợp lý làm room number (loại bỏ dates, etc)
-                    if not re.match(r'^(19|20)\d{2}$', room):  # Không phải năm
-                        rooms.append(room)
+        # Quét toàn bộ text một lần: \b đã tách các dòng nên kết quả giống quét từng dòng
+        rooms = set()
+        rooms_add = rooms.add
+        for room in _ROOM_RE.findall(content):
+            # Filter ra những số hợp lý làm room number (loại bỏ dates, etc)
+            if room[:2] not in _YEAR_PREFIXES:  # Không phải năm
+                rooms_add(room)
         
-        # Remove duplicates and sort
-        unique_rooms = sorted(list(set(rooms)))
+        # Set đã loại trùng - chỉ cần decode và sort
+        unique_rooms = sorted(room.decode('ascii') for room in rooms)
         
-        print(f"✅ {file_type}: Extracted {len(unique_rooms)} rooms")
-        if unique_rooms:
-            if len(unique_rooms) <= 10:
-                print(f"   Rooms: {', '.join(unique_rooms)}")
-            else:
-                first_5 = ', '.join(unique_rooms[:5])
-                last_5 = ', '.join(unique_rooms[-5:])
-                print(f"   First 5: {first_5}")
-                print(f"   Last 5:  {last_5}")
+        if len(unique_rooms) <= 10:
+            logger.info("✅ %s: Extracted %d rooms: %s",
+                        file_type, len(unique_rooms), ', '.join(unique_rooms))
+        else:
+            logger.info("✅ %s: Extracted %d rooms (first 5: %s | last 5: %s)",
+                        file_type, len(unique_rooms),
+                        ', '.join(unique_rooms[:5]), ', '.join(unique_rooms[-5:]))
         
         return unique_rooms
         
     except Exception as e:
-        print(f"❌ Error processing {file_type}: {e}")
+        logger.error("❌ Error processing %s: %s", file_type, e)
         return []
 
 
@@ -110,90 +177,45 @@ def extract_rooms_from_gih(pdf_path, schedule_date):
     - OD: Phòng ở qua đêm (không check-in/out ngày schedule)
     - ARR: Phòng check-in = schedule date (bổ sung cho file ARR)
     """
-    print(f"📄 Processing GIH file: {pdf_path}")
+    logger.info("📄 Processing GIH file: %s", pdf_path)
     
     # Convert to text
-    text_path = pdf_to_text(pdf_path)
-    if not text_path:
+    return parse_rooms_from_gih(pdf_to_text_bytes(pdf_path), schedule_date)
+
+
+def parse_rooms_from_gih(content, schedule_date):
+    """Đọc và phân loại phòng GIH từ text (bytes) đã convert"""
+    if not content:
         return {'ARR': [], 'OD': []}
     
     try:
-        with open(text_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        lines = content.split('\n')
-        
-        # Find header để xác định column positions
-        header_line_idx = None
-        for i, line in enumerate(lines):
-            line_lower = line.lower()
-            if ('room' in line_lower and 'arr' in line_lower and 'dep' in line_lower):
-                header_line_idx = i
-                break
+        # Extract and classify room data in one pass over the whole text:
+        # room number at line start, then check-in and check-out dates
+        # (DD-MM-YY) on the same line. Keyed on (room, checkin, checkout)
+        # to drop duplicates
+        schedule_date_b = schedule_date.encode('ascii')
+        seen = set()
+        arr_set = set()  # Additional ARR from GIH
+        od_set = set()   # OD (over day) rooms
         
-        # Extract room data
-        room_data = []
-        
-        for i, line in enumerate(lines):
-            line_clean = line.strip()
-            if not line_clean:
+        for match in _GIH_LINE_RE.finditer(content):
+            key = match.group(1, 2, 3)
+            if key in seen:
                 continue
-            
-            # Look for lines starting with room number
-            room_match = re.match(r'^(\d{4})', line_clean)
-            
-            if room_match:
-                room_number = room_match.group(1)
-                
-                # Look for dates in current line (format: DD-MM-YY)
-                dates_found = re.findall(r'\b(\d{2}-\d{2}-\d{2})\b', line_clean)
-                
-                if len(dates_found) >= 2:
-                    checkin_date = dates_found[0]
-                    checkout_date = dates_found[1]
-                    
-                    room_data.append({
-                        'room': room_number,
-                        'checkin': checkin_date,
-                        'checkout': checkout_date
-                    })
-        
-        # Remove duplicates
-        seen_rooms = set()
-        unique_room_data = []
-        
-        for data in room_data:
-            room_key = f"{data['room']}_{data['checkin']}_{data['checkout']}"
-            if room_key not in seen_rooms:
-                seen_rooms.add(room_key)
-                unique_room_data.append(data)
-        
-        # Classify rooms according to schedule date
-        gih_arr_rooms = []  # Additional ARR from GIH
-        gih_od_rooms = []   # OD (over day) rooms
-        
-        for room_info in unique_room_data:
-            room = room_info['room']
-            checkin = room_info['checkin']
-            checkout = room_info['checkout']
-            
-            if checkin == schedule_date:
+            seen.add(key)
+            room, checkin, checkout = key
+            if checkin == schedule_date_b:
                 # Check-in = schedule date → Additional ARR
-                gih_arr_rooms.append(room)
-            elif checkout == schedule_date:
-                # Check-out = schedule date → Skip (handled by DEP file)
-                pass
-            else:
-                # Over day → OD
-                gih_od_rooms.append(room)
+                arr_set.add(room)
+            elif checkout != schedule_date_b:
+                # Over day → OD (check-out = schedule date is handled by DEP file)
+                od_set.add(room)
         
-        # Remove duplicates and sort
-        gih_arr_rooms = sorted(list(set(gih_arr_rooms)))
-        gih_od_rooms = sorted(list(set(gih_od_rooms)))
+        gih_arr_rooms = sorted(room.decode('ascii') for room in arr_set)
+        gih_od_rooms = sorted(room.decode('ascii') for room in od_set)
         
-        print(f"✅ GIH: Extracted {len(unique_room_data)} total room records")
-        print(f"   Additional ARR: {len(gih_arr_rooms)} rooms")
-        print(f"   OD (Over Day):  {len(gih_od_rooms)} rooms")
+        logger.info("✅ GIH: Extracted %d total room records (additional ARR: %d, OD: %d)",
+                    len(seen), len(gih_arr_rooms), len(gih_od_rooms))
         
         return {
             'ARR': gih_arr_rooms,
@@ -201,11 +223,11 @@ def extract_rooms_from_gih(pdf_path, schedule_date):
         }
         
     except Exception as e:
-        print(f"❌ Error processing GIH: {e}")
+        logger.error("❌ Error processing GIH: %s", e)
         return {'ARR': [], 'OD': []}
 
 
-def master_room_classification(arr_file, dep_file, gih_file, schedule_date):
+def master_room_classification(arr_file, dep_file, gih_file, schedule_date, present=None):
     """
     Master function để phân loại phòng từ cả 3 files
     """
@@ -213,28 +235,39 @@ def master_room_classification(arr_file, dep_file, gih_file, schedule_date):
     print(f"Schedule Date: {schedule_date}")
     print("=" * 60)
     
+    # Convert all 3 PDFs at once - each pdftotext run is an independent subprocess
+    contents = {}
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = {}
+        for file_type, pdf_path in [("ARR", arr_file), ("DEP", dep_file), ("GIH", gih_file)]:
+            # main() đã stat sẵn các file - chỉ gọi os.path.exists khi không có
+            exists = present.get(pdf_path, False) if present is not None else os.path.exists(pdf_path)
+            if exists:
+                print(f"📄 Converting {file_type} file: {pdf_path}")
+                futures[file_type] = executor.submit(pdf_to_text_bytes, pdf_path)
+        for file_type, future in futures.items():
+            contents[file_type] = future.result()
+    
     # Step 1: Extract ARR rooms from ARR file
     print("\n📋 STEP 1: Processing ARR file")
-    arr_rooms = extract_rooms_from_arr_dep(arr_file, "ARR") if os.path.exists(arr_file) else []
+    arr_rooms = parse_rooms_from_arr_dep(contents["ARR"], "ARR") if "ARR" in contents else []
     
     # Step 2: Extract DEP rooms from DEP file  
     print("\n📋 STEP 2: Processing DEP file")
-    dep_rooms = extract_rooms_from_arr_dep(dep_file, "DEP") if os.path.exists(dep_file) else []
+    dep_rooms = parse_rooms_from_arr_dep(contents["DEP"], "DEP") if "DEP" in contents else []
     
     # Step 3: Extract OD + additional ARR from GIH file
     print("\n📋 STEP 3: Processing GIH file")
-    gih_result = extract_rooms_from_gih(gih_file, schedule_date) if os.path.exists(gih_file) else {'ARR': [], 'OD': []}
+    gih_result = parse_rooms_from_gih(contents["GIH"], schedule_date) if "GIH" in contents else {'ARR': [], 'OD': []}
     
     # Step 4: Combine results
     print("\n📋 STEP 4: Combining results")
     
     # Combine ARR (from ARR file + GIH additional)
-    combined_arr = list(set(arr_rooms + gih_result['ARR']))
-    combined_arr.sort()
+    combined_arr = sorted(set(arr_rooms).union(gih_result['ARR']))
     
-    # DEP (from DEP file only)
-    combined_dep = dep_rooms.copy()
-    combined_dep.sort()
+    # DEP (from DEP file only) - parse_rooms_from_arr_dep đã trả về list sorted
+    combined_dep = dep_rooms
     
     # OD (from GIH only)
     combined_od = gih_result['OD']
@@ -248,13 +281,7 @@ def master_room_classification(arr_file, dep_file, gih_file, schedule_date):
 
 def edit_room_list_manual(category, current_rooms):
     """Cho phép edit thủ công danh sách phòng"""
-    category_names = {
-        'ARR': 'ARRIVAL (Khách đến)',
-        'DEP': 'DEPARTURE (Khách đi)', 
-        'OD': 'OVER DAY (Khách ở qua đêm)'
-    }
-    
-    print(f"\n✏️  EDIT {category} - {category_names[category]}")
+    print(f"\n✏️  EDIT {category} - {_CATEGORY_NAMES_VI[category]}")
     print("=" * 50)
     print(f"Hiện tại có {len(current_rooms)} phòng")
     
@@ -279,8 +306,7 @@ def edit_room_list_manual(category, current_rooms):
         add_rooms = input("Nhập phòng cần thêm (cách nhau bởi dấu phẩy): ").strip()
         if add_rooms:
             new_rooms = [room.strip() for room in add_rooms.split(',') if room.strip()]
-            updated_rooms = list(set(current_rooms + new_rooms))
-            updated_rooms.sort()
+            updated_rooms = sorted(set(current_rooms).union(new_rooms))
             print(f"✅ Đã thêm {len(new_rooms)} phòng. Tổng: {len(updated_rooms)} phòng")
             return updated_rooms
         return current_rooms
@@ -325,7 +351,7 @@ def manual_edit_workflow(classifications):
     
     for category in ['ARR', 'DEP', 'OD']:
         current_rooms = classifications.get(category, [])
-        edited_rooms = edit_room_list_manual(category, current_rooms.copy())
+        edited_rooms = edit_room_list_manual(category, current_rooms)
         edited_classifications[category] = edited_rooms
     
     return edited_classifications
@@ -341,13 +367,7 @@ def display_final_results(classifications, title="FINAL CLASSIFICATION RESULTS")
         count = len(rooms)
         total_rooms += count
         
-        category_names = {
-            'ARR': 'ARRIVAL (Khách đến)',
-            'DEP': 'DEPARTURE (Khách đi)', 
-            'OD': 'OVER DAY (Khách ở qua đêm)'
-        }
-        
-        print(f"\n{category}: {count:3d} phòng - {category_names[category]}")
+        print(f"\n{category}: {count:3d} phòng - {_CATEGORY_NAMES_VI[category]}")
         print("-" * 40)
         
         if rooms:
@@ -367,13 +387,7 @@ def export_for_web(classifications):
     print("=" * 50)
     
     for category, rooms in classifications.items():
-        category_names = {
-            'ARR': 'ARRIVAL',
-            'DEP': 'DEPARTURE', 
-            'OD': 'OVER DAY'
-        }
-        
-        print(f"\n{category} ({category_names[category]}):")
+        print(f"\n{category} ({_CATEGORY_NAMES_EN[category]}):")
         if rooms:
             rooms_str = ', '.join(rooms)
             print(rooms_str)
@@ -393,6 +407,8 @@ def export_for_web(classifications):
 
 def main():
     """Main function"""
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    
     print("🏨 HOTEL ROOM CLASSIFICATION SYSTEM")
     print("=" * 70)
     
@@ -401,19 +417,18 @@ def main():
     dep_file = "dep14.08.25 (1).PDF"
     gih_file = "GIH01103 Guests in House by Room (2).PDF"
     
-    # Check if files exist
-    files_status = []
+    # Check if files exist - stat each file once, reused by master_room_classification
+    present = {}
     for filename, filepath in [("ARR", arr_file), ("DEP", dep_file), ("GIH", gih_file)]:
-        exists = os.path.exists(filepath)
-        files_status.append((filename, filepath, exists))
-        status = "✅" if exists else "❌"
+        present[filepath] = os.path.exists(filepath)
+        status = "✅" if present[filepath] else "❌"
         print(f"{status} {filename}: {filepath}")
     
     # Get schedule date
     schedule_date = get_schedule_date_input()
     
     # Process all files
-    classifications = master_room_classification(arr_file, dep_file, gih_file, schedule_date)
+    classifications = master_room_classification(arr_file, dep_file, gih_file, schedule_date, present=present)
     
     # Display initial results
     display_final_results(classifications, "INITIAL CLASSIFICATION RESULTS")
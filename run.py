@@ -2,9 +2,12 @@
 """
 Housekeeping Report Generator
 Web application to process hotel PDFs and generate Excel reports
+
+Development server only - set FLASK_DEBUG=1 for the debugger/reloader.
+Production: gunicorn -c gunicorn.conf.py app:app
 """
 
-from app import app
+from app import app, get_pool
 import os
 
 if __name__ == '__main__':
@@ -24,4 +27,8 @@ if __name__ == '__main__':
     print("Press Ctrl+C to stop the server")
     print("-" * 50)
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Start the shared worker pool now rather than on the first request
+    get_pool()
+    
+    # Debug mode (reloader + debugger) runs the app twice and slower - opt in only
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', host='0.0.0.0', port=5000)
@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import master_room_classifier as mrc
+
+
+class PdfToTextCacheTest(unittest.TestCase):
+    """pdf_to_text_bytes dùng lại file .txt cạnh PDF thay vì chạy lại pdftotext"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pdf_path = os.path.join(self.tmp_dir.name, 'ARR.pdf')
+        with open(self.pdf_path, 'wb') as f:
+            f.write(b'%PDF-1.4 test')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _run(self, stdout=b'0211  Guest\n'):
+        return mock.patch.object(mrc.subprocess, 'run', return_value=subprocess.CompletedProcess(
+            args=[], returncode=0, stdout=stdout, stderr=b''))
+
+    def test_second_call_reads_cache_without_subprocess(self):
+        with self._run() as run:
+            first = mrc.pdf_to_text_bytes(self.pdf_path)
+            second = mrc.pdf_to_text_bytes(self.pdf_path)
+        self.assertEqual(first, b'0211  Guest\n')
+        self.assertEqual(second, first)
+        self.assertEqual(run.call_count, 1)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, 'ARR.txt')))
+
+    def test_pdf_newer_than_cache_is_converted_again(self):
+        with self._run():
+            mrc.pdf_to_text_bytes(self.pdf_path)
+        text_path = os.path.join(self.tmp_dir.name, 'ARR.txt')
+        pdf_mtime = os.path.getmtime(self.pdf_path)
+        os.utime(text_path, (pdf_mtime - 10, pdf_mtime - 10))
+
+        with self._run(stdout=b'0305  Guest\n') as run:
+            text = mrc.pdf_to_text_bytes(self.pdf_path)
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(text, b'0305  Guest\n')
+
+    def test_failure_prints_pdftotext_stderr(self):
+        failed = subprocess.CompletedProcess(args=[], returncode=1, stdout=b'',
+                                             stderr=b"Syntax Error: Couldn't find trailer dictionary\n")
+        with mock.patch.object(mrc.subprocess, 'run', return_value=failed), \
+                mock.patch('builtins.print') as printed:
+            self.assertIsNone(mrc.pdf_to_text_bytes(self.pdf_path))
+        self.assertIn("Couldn't find trailer dictionary", printed.call_args[0][0])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, 'ARR.txt')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,18 +5,53 @@ Cho phép upload PDF files và xử lý tự động
 """
 
 from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file
+import base64
+import copy
+import hashlib
+import io
+import logging
 import os
 import subprocess
 import tempfile
 import re
-import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 from werkzeug.utils import secure_filename
-from pdf2image import convert_from_path
+from werkzeug.wsgi import FileWrapper
 from PIL import Image
 import pytesseract
 import zipfile
 import shutil
+import threading
+import time
+import traceback
+import openpyxl
+import pypdfium2 as pdfium
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from flask.json.provider import DefaultJSONProvider
+from excel_to_image import PREVIEW_DPI
+
+# Dùng google-re2 (DFA, thời gian tuyến tính) cho các regex quét cả file text nếu có cài
+try:
+    import re2 as _re
+except ImportError:
+    _re = re
+
+# tesserocr gọi thẳng API tesseract trong process (load model một lần) nếu có cài,
+# không thì pytesseract chạy CLI tesseract cho mỗi ảnh
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# Dùng orjson để serialize response JSON nếu có cài, không thì dùng json của Flask
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Import module xử lý ảnh GIH cải tiến
 from gih_image_processor import process_gih_images as process_gih_images_enhanced
@@ -46,9 +81,30 @@ for path in tesseract_paths:
 else:
     print("⚠️ Warning: Tesseract not found in any common locations")
 
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify() qua orjson - ra thẳng bytes, nhanh hơn json.dumps"""
+
+    def dumps(self, obj, **kwargs):
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def dumps_bytes(self, obj):
+        try:
+            return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return super().dumps(obj).encode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+# Log chẩn đoán (debug) chỉ bật khi không chạy production
+app.logger.setLevel(logging.INFO if os.environ.get('FLASK_ENV') == 'production' else logging.DEBUG)
 
 # Disable CSRF for file uploads if needed
 app.config['WTF_CSRF_ENABLED'] = False
@@ -58,36 +114,191 @@ UPLOAD_FOLDER = os.path.join(os.getcwd(), 'temp_uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-ALLOWED_EXTENSIONS = {'pdf', 'PDF'}
-IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'JPG', 'JPEG', 'PNG'}
+# Sau nginx/Apache có cấu hình X-Sendfile: server gửi file thẳng từ kernel, Flask chỉ trả header
+app.use_x_sendfile = os.environ.get('USE_X_SENDFILE') == '1'
+
+# Server chạy bằng app.run() không có wsgi.file_wrapper - Werkzeug đọc file 8KB mỗi lần;
+# đọc 256KB để file Excel/PNG vài MB không tốn hàng trăm lượt read()/write()
+SEND_FILE_BUFFER_SIZE = 256 * 1024
+
+class _LargeFileWrapper(FileWrapper):
+    """FileWrapper với buffer tối thiểu SEND_FILE_BUFFER_SIZE"""
+    def __init__(self, file, buffer_size=SEND_FILE_BUFFER_SIZE):
+        super().__init__(file, max(buffer_size, SEND_FILE_BUFFER_SIZE))
+
+@app.before_request
+def _use_large_file_wrapper():
+    # Keep a wrapper the WSGI server provides itself (gunicorn's uses sendfile)
+    request.environ.setdefault('wsgi.file_wrapper', _LargeFileWrapper)
+
+# Uploaded GIH images are only needed while a request runs - they go to
+# temp files, copied in 1MB chunks (PDFs are read into memory)
+UPLOAD_BUFFER_SIZE = 1 << 20
+
+# Kết quả trích phòng theo hash nội dung PDF - cùng báo cáo upload lại thì
+# không phải convert/parse lại
+EXTRACT_CACHE_SIZE = 128
+_EXTRACT_CACHE = OrderedDict()
+_EXTRACT_CACHE_LOCK = threading.Lock()
+
+# Regex dùng khi parse text PDF/OCR - compile một lần
+_ROOM_HEAD_RE = re.compile(r'^\s*(\d{4})\b')   # Số phòng ở đầu dòng
+_ROOM_RE = re.compile(r'\b(\d{4})\b')            # Số 4 chữ số bất kỳ trong dòng
+_YEAR_PREFIXES = frozenset(('19', '20'))          # 19xx/20xx là năm, không phải phòng
+_OCR_DATE_RE = re.compile(r'\b(\d{2}[-/]\d{2}[-/]\d{2})\b')  # DD-MM-YY hoặc DD/MM/YY
+_ROOM_LIST_RE = re.compile(r'[^,\s](?:[^,]*[^,\s])?')  # Một mục (đã strip) trong danh sách phòng cách nhau bởi dấu phẩy
+_OCR_SKIP_NUMBERS = frozenset(('1844', '1103'))  # Số giờ/mã tham chiếu hay gặp, không phải phòng
+# Quét cả file text một lần (multiline): số phòng ở đầu dòng ARR/DEP, và dòng
+# GIH gồm số phòng đầu dòng + ngày check-in + ngày check-out (DD-MM-YY)
+_ROOM_LINE_RE = _re.compile(r'(?m)^[^\S\n]*(\d{4})\b')
+_GIH_LINE_RE = _re.compile(
+    r'(?m)^[^\S\n]*(\d{4})'
+    r'[^\n]*?\b(\d{2}-\d{2}-\d{2})\b'
+    r'[^\n]*?\b(\d{2}-\d{2}-\d{2})\b'
+)
+
+# pdftotext (poppler-utils) chỉ cần tìm một lần - không có thì dùng thẳng pypdfium2
+PDFTOTEXT_PATH = shutil.which('pdftotext')
+# PDFium không thread-safe - mọi thao tác pypdfium2 (mở, lấy text, render) đi qua một lock,
+# upload chạy trên nhiều thread và app.run() phục vụ nhiều request cùng lúc
+_PDFIUM_LOCK = threading.Lock()
+# LibreOffice trên máy (nếu có) convert Excel → PDF, không cần gọi ComPDF API
+SOFFICE_PATH = shutil.which('soffice') or shutil.which('libreoffice')
+# unoconvert (unoserver) nói chuyện với một LibreOffice đang chạy sẵn - không phải khởi động lại mỗi lần
+UNOCONVERT_PATH = shutil.which('unoconvert')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Ảnh preview của Excel: lề giữ lại khi cắt (px), và cache PNG/PDF theo hash nội dung
+# Excel trong UPLOAD_FOLDER/.cache (giới hạn dung lượng, xoá LRU) - cùng thư mục với cache
+# file Excel theo đầu vào của create_excel_output. Độ phân giải PREVIEW_DPI dùng chung
+# với excel_to_image.py
+PREVIEW_PADDING = 20
+IMAGE_CACHE_DIRNAME = '.cache'
+IMAGE_CACHE_MAX_BYTES = 200 * 1024 * 1024
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
+    return filename.lower().endswith('.pdf')
 
 def allowed_image_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1] in IMAGE_EXTENSIONS
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
 
 def allowed_zip_file(filename):
     return filename.lower().endswith('.zip')
 
+def _upload_size(file_storage):
+    """Kích thước file upload (bytes) - seek tới cuối stream thay vì đọc cả file"""
+    stream = file_storage.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+def _read_upload(file_storage):
+    """Đọc file upload vào bộ nhớ, trả về (bytes, hash nội dung) - PDF không cần ra đĩa"""
+    data = file_storage.stream.read()
+    return data, hashlib.blake2b(data, digest_size=16).digest()
+
+def _save_upload_to_temp(file_storage, prefix, suffix):
+    """Copy file upload ra temp file theo chunk 1MB, trả về đường dẫn"""
+    tmp = tempfile.NamedTemporaryFile(prefix=prefix, suffix=suffix, delete=False)
+    try:
+        with tmp:
+            shutil.copyfileobj(file_storage.stream, tmp, UPLOAD_BUFFER_SIZE)
+    except Exception:
+        os.remove(tmp.name)
+        raise
+    return tmp.name
+
+def _cached_extract(cache_key, extract_func, *args):
+    """Gọi extract_func(*args), dùng lại kết quả nếu cùng file (hash) đã xử lý gần đây"""
+    with _EXTRACT_CACHE_LOCK:
+        if cache_key in _EXTRACT_CACHE:
+            _EXTRACT_CACHE.move_to_end(cache_key)
+            return copy.deepcopy(_EXTRACT_CACHE[cache_key])
+    
+    rooms = extract_func(*args)
+    
+    # Only cache real results - an empty one may be a failed extraction
+    if rooms and (not isinstance(rooms, dict) or any(rooms.values())):
+        with _EXTRACT_CACHE_LOCK:
+            _EXTRACT_CACHE[cache_key] = copy.deepcopy(rooms)
+            while len(_EXTRACT_CACHE) > EXTRACT_CACHE_SIZE:
+                _EXTRACT_CACHE.popitem(last=False)
+    return rooms
+
+# Ảnh scan lớn hơn cỡ này (px, cạnh dài) được thu nhỏ trước khi OCR
+OCR_MAX_SIDE = 2400
+
+# Mỗi thread một API tesserocr (API không thread-safe) - chạy trên pool thread sống suốt
+# process nên model chỉ load một lần mỗi thread
+_TESS_LOCAL = threading.local()
+_OCR_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='ocr') if tesserocr is not None else None
+
+def _tesserocr_text(image):
+    """OCR một ảnh PIL bằng tesserocr API của thread hiện tại (psm 6, giữ khoảng trắng giữa các từ)"""
+    api = getattr(_TESS_LOCAL, 'api', None)
+    if api is None:
+        api = tesserocr.PyTessBaseAPI(lang='eng', psm=tesserocr.PSM.SINGLE_BLOCK, oem=tesserocr.OEM.DEFAULT)
+        api.SetVariable('preserve_interword_spaces', '1')
+        _TESS_LOCAL.api = api
+    api.SetImage(image)
+    return api.GetUTF8Text()
+
+def _downscale_for_ocr(image):
+    """Scan rất lớn: grayscale + thu nhỏ về OCR_MAX_SIDE (trả về ảnh mới), ảnh thường trả về nguyên ảnh"""
+    if max(image.size) <= OCR_MAX_SIDE:
+        return image
+    image = image.convert('L')
+    image.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.LANCZOS)
+    print(f"   Downscaled to {image.size} grayscale")
+    return image
+
+def _batch_ocr_path(image_path, work_dir):
+    """Đường dẫn đưa vào file danh sách của tesseract - ảnh quá lớn được thu nhỏ ra PNG tạm trong work_dir"""
+    with Image.open(image_path) as source:
+        image = _downscale_for_ocr(source)
+        if image is source:
+            return os.path.abspath(image_path)
+        try:
+            fd, small_path = tempfile.mkstemp(suffix='.png', dir=work_dir)
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, 'PNG')
+            return small_path
+        finally:
+            image.close()
+
 def extract_text_from_image(image_path):
     """Extract text from image using OCR (pytesseract)"""
     try:
         print(f"🔍 Processing image: {os.path.basename(image_path)}")
         
-        # Open image with PIL
-        image = Image.open(image_path)
-        print(f"   Image size: {image.size}, mode: {image.mode}")
-        
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-            print(f"   Converted to RGB mode")
-        
-        # Use pytesseract to extract text with better configuration for hotel data
-        # config options: preserve_interword_spaces to maintain table structure
-        custom_config = r'--oem 3 --psm 6 -c preserve_interword_spaces=1'
-        text = pytesseract.image_to_string(image, lang='eng', config=custom_config)
+        # Open image with PIL (lazy - only the header is read here); the file and any
+        # converted copy are closed right after OCR instead of waiting for GC
+        with Image.open(image_path) as source:
+            print(f"   Image size: {source.size}, mode: {source.mode}")
+            image = source
+            try:
+                # Very large scans: grayscale + downscale first - tesseract gets 1 channel and far fewer pixels
+                image = _downscale_for_ocr(image)
+                large = image is not source
+                
+                # config options: preserve_interword_spaces to maintain table structure
+                if tesserocr is not None:
+                    # tesserocr takes the decoded pixels directly - no intermediate file
+                    if image.mode not in ('RGB', 'L'):
+                        image = image.convert('RGB')
+                        print(f"   Converted to RGB mode")
+                    text = _tesserocr_text(image)
+                else:
+                    # Give tesseract the uploaded file itself - passing the PIL image would make
+                    # pytesseract decode it and re-encode a temp PNG first (worth it only once downscaled)
+                    custom_config = r'--oem 3 --psm 6 -c preserve_interword_spaces=1'
+                    text = pytesseract.image_to_string(image if large else image_path, lang='eng', config=custom_config)
+            finally:
+                if image is not source:
+                    image.close()
         
         lines_found = len([line for line in text.split('\n') if line.strip()])
         print(f"   ✅ OCR completed: {lines_found} non-empty lines extracted")
@@ -99,6 +310,35 @@ def extract_text_from_image(image_path):
         print(f"   Check if tesseract is properly configured: {pytesseract.pytesseract.tesseract_cmd}")
         return ""
 
+def extract_text_from_images(image_paths):
+    """OCR nhiều ảnh trong một lần gọi tesseract (file danh sách ảnh) - chỉ load language data một lần"""
+    if _OCR_EXECUTOR is not None:
+        # tesserocr releases the GIL while recognizing - OCR the images in parallel
+        # on the OCR threads, page order kept by map()
+        return '\n'.join(_OCR_EXECUTOR.map(extract_text_from_image, image_paths))
+    
+    if len(image_paths) < 2:
+        return '\n'.join(extract_text_from_image(path) for path in image_paths)
+    
+    # File danh sách + các bản thu nhỏ của ảnh quá lớn (cùng tiền xử lý như OCR từng ảnh)
+    work_dir = tempfile.mkdtemp(prefix='ocr_batch_')
+    try:
+        batch_paths = [_batch_ocr_path(path, work_dir) for path in image_paths]
+        list_path = os.path.join(work_dir, 'images.txt')
+        with open(list_path, 'w') as list_file:
+            list_file.write('\n'.join(batch_paths) + '\n')
+        
+        print(f"🔍 Processing {len(image_paths)} images in one tesseract batch")
+        custom_config = r'--oem 3 --psm 6 -c preserve_interword_spaces=1'
+        # Pages come back separated by form feeds - whitespace for the line parser
+        return pytesseract.image_to_string(list_path, lang='eng', config=custom_config)
+    
+    except Exception as e:
+        print(f"⚠️ Batch OCR failed ({e}), processing images one by one")
+        return '\n'.join(extract_text_from_image(path) for path in image_paths)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
 def extract_rooms_from_gih_images(image_paths, schedule_date):
     """Extract and classify rooms from GIH image files using enhanced OCR
     Uses the improved gih_image_processor module with context-aware error fixing
@@ -125,13 +365,8 @@ def extract_rooms_from_gih_images(image_paths, schedule_date):
 def extract_rooms_from_gih_images_legacy(image_paths, schedule_date):
     """Legacy method for processing GIH images (fallback)"""
     try:
-        all_lines = []
-        
         # Extract text from all images and collect lines
-        for image_path in image_paths:
-            text = extract_text_from_image(image_path)
-            lines = text.split('\n')
-            all_lines.extend(lines)
+        all_lines = extract_text_from_images(image_paths).split('\n')
         
         room_data = []
         
@@ -141,24 +376,17 @@ def extract_rooms_from_gih_images_legacy(image_paths, schedule_date):
                 continue
             
             # First, try to find room number at the beginning of line (like PDF processing)
-            room_match = re.match(r'^\s*(\d{4})\b', line_clean)
+            room_match = _ROOM_HEAD_RE.match(line_clean)
             if room_match:
                 room_number = room_match.group(1)
                 
                 # Skip years (19xx, 20xx)
-                if re.match(r'^(19|20)\d{2}$', room_number):
+                if room_number[:2] in _YEAR_PREFIXES:
                     continue
                 
                 # Now extract dates from the same line
-                # Look for patterns like "11-08-25" or "11/08/25" 
-                dates_found = re.findall(r'\b(\d{2}[-/]\d{2}[-/]\d{2})\b', line_clean)
-                
-                # Convert different date formats to DD-MM-YY
-                normalized_dates = []
-                for date_str in dates_found:
-                    # Handle both DD-MM-YY and DD/MM/YY formats
-                    date_clean = date_str.replace('/', '-')
-                    normalized_dates.append(date_clean)
+                # Look for patterns like "11-08-25" or "11/08/25", normalized to DD-MM-YY
+                normalized_dates = _OCR_DATE_RE.findall(line_clean.replace('/', '-'))
                 
                 if len(normalized_dates) >= 2:
                     # Typically first date is check-in, second is check-out
@@ -184,19 +412,17 @@ def extract_rooms_from_gih_images_legacy(image_paths, schedule_date):
                     print(f"Room {room_number} found but no dates in line: {line_clean[:30]}...")
             else:
                 # Alternative approach: find any room numbers in the line with their nearby dates
-                room_matches = re.findall(r'\b(\d{4})\b', line_clean)
+                room_matches = _ROOM_RE.findall(line_clean)
+                # The line's dates are the same for every room on it - extract them once
+                normalized_dates = _OCR_DATE_RE.findall(line_clean.replace('/', '-')) if room_matches else ()
                 for room_number in room_matches:
                     # Skip years and common numbers
-                    if re.match(r'^(19|20)\d{2}$', room_number):
+                    if room_number[:2] in _YEAR_PREFIXES:
                         continue
-                    if room_number in ['1844', '1103']:  # Skip common time/reference numbers
+                    if room_number in _OCR_SKIP_NUMBERS:  # Skip common time/reference numbers
                         continue
                         
-                    # Extract dates from the same line 
-                    dates_found = re.findall(r'\b(\d{2}[-/]\d{2}[-/]\d{2})\b', line_clean)
-                    
-                    if len(dates_found) >= 2:
-                        normalized_dates = [date_str.replace('/', '-') for date_str in dates_found]
+                    if len(normalized_dates) >= 2:
                         checkin_date = normalized_dates[0]
                         checkout_date = normalized_dates[1]
                         
@@ -207,22 +433,20 @@ def extract_rooms_from_gih_images_legacy(image_paths, schedule_date):
                             'source_line': line_clean[:50]
                         })
         
-        # Remove duplicates based on room + dates combination
-        seen_rooms = set()
-        unique_room_data = []
+        # Remove duplicates based on room + dates combination (dict keeps first-seen order)
+        unique_room_data = {}
         
         for data in room_data:
-            room_key = f"{data['room']}_{data['checkin']}_{data['checkout']}"
-            if room_key not in seen_rooms:
-                seen_rooms.add(room_key)
-                unique_room_data.append(data)
+            room_key = (data['room'], data['checkin'], data['checkout'])
+            if room_key not in unique_room_data:
+                unique_room_data[room_key] = data
                 print(f"Found: Room {data['room']}, CI: {data['checkin']}, CO: {data['checkout']}")
         
         # Classify rooms based on schedule date
         gih_arr_rooms = []
         gih_od_rooms = []
         
-        for room_info in unique_room_data:
+        for room_info in unique_room_data.values():
             room = room_info['room']
             checkin = room_info['checkin']
             checkout = room_info['checkout']
@@ -241,211 +465,267 @@ def extract_rooms_from_gih_images_legacy(image_paths, schedule_date):
         print(f"Legacy GIH Images processed: {len(gih_arr_rooms)} ARR, {len(gih_od_rooms)} OD")
         
         return {
-            'ARR': sorted(list(set(gih_arr_rooms))),
-            'OD': sorted(list(set(gih_od_rooms)))
+            'ARR': sorted(set(gih_arr_rooms)),
+            'OD': sorted(set(gih_od_rooms))
         }
         
     except Exception as e:
         print(f"Error processing GIH images (legacy): {e}")
-        import traceback
         traceback.print_exc()
         return {'ARR': [], 'OD': []}
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
-
-def pdf_to_text(pdf_path):
-    """Convert PDF thành text sử dụng pdfplumber (không cần pdftotext)"""
-    text_path = pdf_path.replace('.pdf', '.txt').replace('.PDF', '.txt')
-    
+def pdf_to_text(pdf_data):
+    """Convert PDF (bytes) thành text (str) - pdftotext nếu có, không thì pypdfium2"""
     # Check file size first (limit to 10MB on server)
-    try:
-        file_size = os.path.getsize(pdf_path)
-        max_size = 10 * 1024 * 1024  # 10MB
-        print(f"📄 PDF file size: {file_size} bytes ({file_size/1024/1024:.1f}MB)")
-        
-        if file_size > max_size:
-            print(f"⚠️ PDF file too large: {file_size/1024/1024:.1f}MB > {max_size/1024/1024:.1f}MB")
-            return None
-    except Exception as e:
-        print(f"Error checking file size: {e}")
+    file_size = len(pdf_data)
+    max_size = 10 * 1024 * 1024  # 10MB
+    print(f"📄 PDF file size: {file_size} bytes ({file_size/1024/1024:.1f}MB)")
+    
+    if file_size > max_size:
+        print(f"⚠️ PDF file too large: {file_size/1024/1024:.1f}MB > {max_size/1024/1024:.1f}MB")
         return None
     
-    try:
-        # Try system pdftotext first with timeout
-        print(f"🔧 Trying pdftotext extraction...")
-        cmd = ['pdftotext', '-layout', pdf_path, text_path]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)  # Increased timeout
-        
-        if result.returncode == 0 and os.path.exists(text_path):
-            print(f"✅ pdftotext successful")
-            return text_path
-        else:
-            print(f"⚠️ pdftotext failed: {result.stderr}")
-    except subprocess.TimeoutExpired:
-        print(f"⏰ pdftotext timeout after 60 seconds")
-    except Exception as e:
-        print(f"❌ pdftotext error: {e}")
+    if PDFTOTEXT_PATH:
+        try:
+            # Try system pdftotext first with timeout
+            print(f"🔧 Trying pdftotext extraction...")
+            # PDF in on stdin, text out on stdout ('-') - nothing goes through temp files
+            cmd = [PDFTOTEXT_PATH, '-layout', '-', '-']
+            # pypdfium2 fallback is fast, so don't wait long on a stuck pdftotext
+            result = subprocess.run(cmd, input=pdf_data, capture_output=True, timeout=10)
+            
+            if result.returncode == 0:
+                print(f"✅ pdftotext successful")
+                return result.stdout.decode('utf-8', errors='replace')
+            else:
+                print(f"⚠️ pdftotext failed: {result.stderr.decode('utf-8', errors='replace')}")
+        except subprocess.TimeoutExpired:
+            print(f"⏰ pdftotext timeout after 10 seconds")
+        except Exception as e:
+            print(f"❌ pdftotext error: {e}")
     
-    # Fallback to pdfplumber
+    # Fallback to pypdfium2 (PDFium) - only raw text is needed, no layout analysis
     try:
-        print(f"🔧 Falling back to pdfplumber...")
-        import pdfplumber
-        
-        with pdfplumber.open(pdf_path) as pdf:
-            text_content = ""
-            total_pages = len(pdf.pages)
-            print(f"📖 PDF has {total_pages} pages")
-            
-            # Limit processing to first 20 pages to avoid timeout
-            max_pages = min(total_pages, 20)
-            for i, page in enumerate(pdf.pages[:max_pages]):
-                if page.extract_text():
-                    text_content += page.extract_text() + "\n"
-                    
-                # Progress logging
-                if (i + 1) % 5 == 0 or i == max_pages - 1:
-                    print(f"   Processed page {i + 1}/{max_pages}")
+        print(f"🔧 Falling back to pypdfium2...")
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_data)
+            try:
+                total_pages = len(pdf)
+                print(f"📖 PDF has {total_pages} pages")
+                
+                # Limit processing to first 20 pages to avoid timeout
+                max_pages = min(total_pages, 20)
+                page_texts = [pdf[i].get_textpage().get_text_range() for i in range(max_pages)]
+                print(f"   Processed {max_pages}/{max_pages} pages")
+            finally:
+                pdf.close()
         
-        # Write to text file
-        with open(text_path, 'w', encoding='utf-8') as f:
-            f.write(text_content)
+        text_content = ''.join(text + "\n" for text in page_texts if text)
         
-        print(f"✅ pdfplumber successful: {len(text_content)} characters extracted")
-        return text_path
+        print(f"✅ pypdfium2 successful: {len(text_content)} characters extracted")
+        return text_content
         
     except Exception as e:
-        print(f"❌ Error extracting PDF text with pdfplumber: {e}")
-        import traceback
+        print(f"❌ Error extracting PDF text with pypdfium2: {e}")
         traceback.print_exc()
         return None
 
-def extract_rooms_from_arr_dep(pdf_path):
-    """Trích xuất số phòng từ file ARR/DEP - chỉ lấy từ cột đầu tiên"""
-    text_path = pdf_to_text(pdf_path)
-    if not text_path:
+def extract_rooms_from_arr_dep(pdf_data):
+    """Trích xuất số phòng từ file ARR/DEP (bytes PDF) - chỉ lấy từ cột đầu tiên"""
+    content = pdf_to_text(pdf_data)
+    if not content:
         return []
     
     try:
-        with open(text_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        lines = content.split('\n')
-        rooms = []
-        
-        for line in lines:
-            line_clean = line.strip()
-            if not line_clean:
-                continue
-                
-            # Chỉ lấy số phòng ở đầu dòng (cột đầu tiên)
-            # Pattern tìm số 4 chữ số ở đầu dòng, có thể có khoảng trắng phía trước
-            room_match = re.match(r'^\s*(\d{4})\b', line_clean)
-            
-            if room_match:
-                room = room_match.group(1)
-                # Kiểm tra không phải năm (19xx hoặc 20xx)
-                if not re.match(r'^(19|20)\d{2}$', room):
-                    rooms.append(room)
-        
-        # Remove duplicates and sort
-        unique_rooms = sorted(list(set(rooms)))
-        
-        # Clean up temp file
-        os.remove(text_path)
-        
-        return unique_rooms
+        # Chỉ lấy số phòng ở đầu dòng (cột đầu tiên), bỏ năm (19xx hoặc 20xx)
+        # Set comprehension removes duplicates as it goes, then sort
+        return sorted({room for room in _ROOM_LINE_RE.findall(content) if room[:2] not in _YEAR_PREFIXES})
         
     except Exception as e:
         return []
 
-def extract_rooms_from_gih(pdf_path, schedule_date):
-    """Trích xuất và phân loại phòng từ file GIH"""
-    text_path = pdf_to_text(pdf_path)
-    if not text_path:
+def extract_rooms_from_gih(pdf_data, schedule_date):
+    """Trích xuất và phân loại phòng từ file GIH (bytes PDF)"""
+    content = pdf_to_text(pdf_data)
+    if not content:
         return {'ARR': [], 'OD': []}
     
     try:
-        with open(text_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        lines = content.split('\n')
-        room_data = []
-        
-        for i, line in enumerate(lines):
-            line_clean = line.strip()
-            if not line_clean:
-                continue
-            
-            room_match = re.match(r'^(\d{4})', line_clean)
-            
-            if room_match:
-                room_number = room_match.group(1)
-                dates_found = re.findall(r'\b(\d{2}-\d{2}-\d{2})\b', line_clean)
-                
-                if len(dates_found) >= 2:
-                    checkin_date = dates_found[0]
-                    checkout_date = dates_found[1]
-                    
-                    room_data.append({
-                        'room': room_number,
-                        'checkin': checkin_date,
-                        'checkout': checkout_date
-                    })
-        
-        # Remove duplicates
-        seen_rooms = set()
-        unique_room_data = []
-        
-        for data in room_data:
-            room_key = f"{data['room']}_{data['checkin']}_{data['checkout']}"
-            if room_key not in seen_rooms:
-                seen_rooms.add(room_key)
-                unique_room_data.append(data)
+        # Dòng có số phòng ở đầu và ít nhất 2 ngày: ngày đầu là check-in, ngày sau là check-out
+        # Classify straight into sets - duplicate rows collapse on their own
+        gih_arr_rooms = set()
+        gih_od_rooms = set()
         
-        # Classify rooms
-        gih_arr_rooms = []
-        gih_od_rooms = []
-        
-        for room_info in unique_room_data:
-            room = room_info['room']
-            checkin = room_info['checkin']
-            checkout = room_info['checkout']
-            
+        for room, checkin, checkout in _GIH_LINE_RE.findall(content):
             if checkin == schedule_date:
-                gih_arr_rooms.append(room)
+                gih_arr_rooms.add(room)
             elif checkout == schedule_date:
                 pass  # Skip DEP rooms from GIH
             else:
-                gih_od_rooms.append(room)
-        
-        # Clean up temp file
-        os.remove(text_path)
+                gih_od_rooms.add(room)
         
         return {
-            'ARR': sorted(list(set(gih_arr_rooms))),
-            'OD': sorted(list(set(gih_od_rooms)))
+            'ARR': sorted(gih_arr_rooms),
+            'OD': sorted(gih_od_rooms)
         }
         
     except Exception as e:
         return {'ARR': [], 'OD': []}
 
+def _find_date_cells(sheet):
+    """Tìm các ô 'Date:' trong vùng 9x9 đầu template"""
+    date_cells = []
+    for row in sheet.iter_rows(min_row=1, max_row=9, max_col=9):
+        for cell in row:
+            if cell.value and 'Date:' in str(cell.value):
+                date_cells.append((cell.row, cell.column))
+                break
+    return date_cells
+
+# Một cụm cột Room/OD/DO/ARR của template (số cột 1-based)
+Section = namedtuple('Section', 'room_col od_col do_col arr_col')
+
+def _find_header_sections(sheet, header_row=4):
+    """Tìm các cụm cột Room/OD/DO/ARR trên dòng header của template"""
+    header_sections = []  # List of Section(room_col, od_col, do_col, arr_col)
+    
+    # Read the whole header row in one pass instead of one sheet.cell() per column
+    header_values = next(sheet.iter_rows(min_row=header_row, max_row=header_row, values_only=True), ())
+    
+    for idx, header_val in enumerate(header_values):
+        if header_val and str(header_val).strip() == 'Room':
+            # Found a room column, next columns should be OD, DO, ARR, NOTE
+            od_header, do_header, arr_header = (header_values[idx + 1:idx + 4] + (None, None, None))[:3]
+            
+            # Verify column headers
+            if (od_header and 'OD' in str(od_header) and 
+                do_header and 'DO' in str(do_header) and 
+                arr_header and 'ARR' in str(arr_header)):
+                
+                room_col = idx + 1
+                header_sections.append(Section(room_col, room_col + 1, room_col + 2, room_col + 3))
+    
+    return header_sections
+
+def _room_ints(rooms):
+    """Set số phòng dạng int (0211 -> 211), bỏ qua giá trị không phải số"""
+    return {int(room) for room in rooms if str(room).strip().isdecimal()}
+
+def _index_room_cells(sheet, header_sections, first_row=5):
+    """Map room number (int) -> [(row, section)] cho các ô Room của template"""
+    room_index = {}
+    for row_num, row_values in enumerate(sheet.iter_rows(min_row=first_row, values_only=True), start=first_row):
+        for section in header_sections:
+            value = row_values[section.room_col - 1]
+            if not value:
+                continue
+            room_value = str(value).strip()
+            if not room_value.isdecimal():
+                continue  # Skip non-numeric room values
+            # int() handles formats like 0211 -> 211
+            room_num = int(room_value)
+            if room_num:
+                room_index.setdefault(room_num, []).append((row_num, section))
+    return room_index
+
+# Template không đổi khi server chạy - đọc bytes và layout (ô Date, các cột
+# Room/OD/DO/ARR, vị trí từng phòng) một lần lúc khởi động, mỗi request chỉ parse lại từ bytes
+TEMPLATE_PATH = 'template.xlsx'
+TEMPLATE_BYTES = None
+TEMPLATE_DATE_CELLS = []
+TEMPLATE_HEADER_SECTIONS = []
+TEMPLATE_ROOM_INDEX = {}
+if os.path.exists(TEMPLATE_PATH):
+    with open(TEMPLATE_PATH, 'rb') as f:
+        TEMPLATE_BYTES = f.read()
+    # Chỉ đọc layout - read_only stream các dòng, không dựng cả cây cell
+    _template_wb = openpyxl.load_workbook(io.BytesIO(TEMPLATE_BYTES), read_only=True)
+    _template_sheet = _template_wb.active
+    TEMPLATE_DATE_CELLS = _find_date_cells(_template_sheet)
+    if not TEMPLATE_DATE_CELLS:
+        print(f"⚠️ Warning: no 'Date:' cell found in {TEMPLATE_PATH} - date will not be written")
+    TEMPLATE_HEADER_SECTIONS = _find_header_sections(_template_sheet)
+    TEMPLATE_ROOM_INDEX = _index_room_cells(_template_sheet, TEMPLATE_HEADER_SECTIONS)
+    _template_wb.close()
+    del _template_wb, _template_sheet
+
+def _link_or_copy(src, dst):
+    """Đưa file cache ra dst bằng hard link (không copy dữ liệu), khác filesystem thì copy"""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return  # already linked - rename() onto the same inode would leave tmp behind
+    tmp = f'{dst}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    # Swap the directory entry - the inode dst pointed to (maybe a cache file) is untouched
+    os.replace(tmp, dst)
+
+def _touch_cache_entry(path):
+    """Đánh dấu file cache vừa dùng cho LRU - chỉ đổi atime, giữ mtime (ETag của send_file)"""
+    os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+
+def _write_atomic(path, data):
+    """Ghi data ra path qua file tạm + os.replace - không bao giờ để lại file ghi dở"""
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def _remove_for_write(path):
+    """Xoá path trước khi ghi đè tại chỗ - path có thể là hard link tới file cache"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _excel_output_key(schedule_date, room_sets, totals):
+    """Hash các đầu vào quyết định nội dung file Excel (template, ngày, phòng đã chuẩn hoá, tổng)"""
+    hasher = hashlib.blake2b(TEMPLATE_BYTES, digest_size=16)
+    hasher.update(repr((schedule_date, [sorted(rooms) for rooms in room_sets], totals)).encode())
+    return hasher.hexdigest()
+
 def create_excel_output(result, schedule_date):
     """Cập nhật template Excel với kết quả phân loại"""
     try:
-        import openpyxl
-        from datetime import datetime
-        
-        # Path to template and output
-        template_path = 'template.xlsx'
+        # Path to output
         output_path = os.path.join(app.config['UPLOAD_FOLDER'], f'room_classification_{schedule_date.replace("-", "")}.xlsx')
         
-        if not os.path.exists(template_path):
-            print(f"Template file not found: {template_path}")
+        if TEMPLATE_BYTES is None:
+            print(f"Template file not found: {TEMPLATE_PATH}")
             return None
         
-        # Load template
-        wb = openpyxl.load_workbook(template_path)
+        # Convert result room numbers to integers for comparison
+        arr_room_ints = _room_ints(result['ARR'])
+        dep_room_ints = _room_ints(result['DEP'])
+        od_room_ints = _room_ints(result['OD'])
+        
+        # Check if manual totals are provided in result
+        ea_total = result.get('manual_ea', len(arr_room_ints))
+        do_total = result.get('manual_do', len(dep_room_ints))
+        od_total = result.get('manual_od', len(od_room_ints))
+        
+        # Same inputs as an earlier request (re-submitted manual edit) -> copy the cached
+        # workbook, no openpyxl build; its image is then a cache hit as well
+        cache_dir = os.path.join(app.config['UPLOAD_FOLDER'], IMAGE_CACHE_DIRNAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        cached_xlsx = os.path.join(cache_dir, _excel_output_key(
+            schedule_date, (arr_room_ints, dep_room_ints, od_room_ints), (ea_total, do_total, od_total)) + '.xlsx')
+        if os.path.exists(cached_xlsx):
+            _touch_cache_entry(cached_xlsx)
+            _link_or_copy(cached_xlsx, output_path)
+            print(f"Excel reused from cache: {output_path}")
+            return output_path
+        
+        # Load template from the cached bytes
+        wb = openpyxl.load_workbook(io.BytesIO(TEMPLATE_BYTES))
         sheet = wb.active
         
         # Parse schedule date to update in template
@@ -456,98 +736,27 @@ def create_excel_output(result, schedule_date):
             formatted_date = schedule_date
         
         # Update date in template (usually in row 3)
-        for row in range(1, 10):
-            for col in range(1, 10):
-                cell_value = sheet.cell(row=row, column=col).value
-                if cell_value and 'Date:' in str(cell_value):
-                    sheet.cell(row=row, column=col, value=f'Date: {formatted_date}')
-                    break
+        for row, col in TEMPLATE_DATE_CELLS:
+            sheet.cell(row=row, column=col, value=f'Date: {formatted_date}')
         
-        # Find header sections (Room, OD, DO, ARR columns)
-        header_sections = []  # List of {room_col, od_col, do_col, arr_col}
-        header_row = 4  # Based on template analysis
-        
-        for col in range(1, sheet.max_column + 1):
-            header_cell = sheet.cell(row=header_row, column=col)
-            if header_cell.value:
-                header_val = str(header_cell.value).strip()
-                if header_val == 'Room':
-                    # Found a room column, next columns should be OD, DO, ARR, NOTE
-                    room_col = col
-                    od_col = col + 1 if col + 1 <= sheet.max_column else None
-                    do_col = col + 2 if col + 2 <= sheet.max_column else None
-                    arr_col = col + 3 if col + 3 <= sheet.max_column else None
-                    
-                    # Verify column headers
-                    od_header = sheet.cell(row=header_row, column=od_col).value if od_col else None
-                    do_header = sheet.cell(row=header_row, column=do_col).value if do_col else None
-                    arr_header = sheet.cell(row=header_row, column=arr_col).value if arr_col else None
-                    
-                    if (od_header and 'OD' in str(od_header) and 
-                        do_header and 'DO' in str(do_header) and 
-                        arr_header and 'ARR' in str(arr_header)):
-                        
-                        header_sections.append({
-                            'room_col': room_col,
-                            'od_col': od_col,
-                            'do_col': do_col,
-                            'arr_col': arr_col
-                        })
+        # Header sections (Room, OD, DO, ARR columns) found at startup
+        header_sections = TEMPLATE_HEADER_SECTIONS
         
         print(f"Found {len(header_sections)} header sections")
         
-        # Convert result room numbers to integers for comparison
-        arr_room_ints = set()
-        for room in result['ARR']:
-            try:
-                arr_room_ints.add(int(room))
-            except:
-                pass
-                
-        dep_room_ints = set()
-        for room in result['DEP']:
-            try:
-                dep_room_ints.add(int(room))
-            except:
-                pass
-                
-        od_room_ints = set()
-        for room in result['OD']:
-            try:
-                od_room_ints.add(int(room))
-            except:
-                pass
-        
         print(f"Room sets: ARR={len(arr_room_ints)}, DEP={len(dep_room_ints)}, OD={len(od_room_ints)}")
         
-        # Mark rooms with X - process each row starting from row 5
+        # Mark rooms with X - only the template cells of rooms in the result
         marked_rooms = {'ARR': 0, 'DEP': 0, 'OD': 0}
         
-        for row_num in range(5, sheet.max_row + 1):
-            for section in header_sections:
-                room_cell = sheet.cell(row=row_num, column=section['room_col'])
-                if room_cell.value:
-                    try:
-                        room_value = str(room_cell.value).strip()
-                        if room_value.isdigit():
-                            # Convert room number (handle formats like 0211 -> 211)
-                            room_num = int(room_value.lstrip('0')) if room_value.startswith('0') else int(room_value)
-                            
-                            # Mark appropriate columns
-                            if room_num in od_room_ints and section['od_col']:
-                                sheet.cell(row=row_num, column=section['od_col'], value='X')
-                                marked_rooms['OD'] += 1
-                            
-                            if room_num in dep_room_ints and section['do_col']:
-                                sheet.cell(row=row_num, column=section['do_col'], value='X')
-                                marked_rooms['DEP'] += 1
-                            
-                            if room_num in arr_room_ints and section['arr_col']:
-                                sheet.cell(row=row_num, column=section['arr_col'], value='X')
-                                marked_rooms['ARR'] += 1
-                                
-                    except ValueError:
-                        continue  # Skip non-numeric room values
+        for category, room_ints, col_field in (('OD', od_room_ints, 'od_col'),
+                                               ('DEP', dep_room_ints, 'do_col'),
+                                               ('ARR', arr_room_ints, 'arr_col')):
+            col_index = Section._fields.index(col_field)
+            for room_num in room_ints & TEMPLATE_ROOM_INDEX.keys():
+                for row_num, section in TEMPLATE_ROOM_INDEX[room_num]:
+                    sheet.cell(row=row_num, column=section[col_index], value='X')
+                    marked_rooms[category] += 1
         
         print(f"Marked rooms: {marked_rooms}")
         
@@ -556,11 +765,6 @@ def create_excel_output(result, schedule_date):
         # DO: = DEP total (column I, next to H38) 
         # OD: = OD total (column K, next to J38)
         try:
-            # Check if manual totals are provided in result
-            ea_total = result.get('manual_ea', len(arr_room_ints))
-            do_total = result.get('manual_do', len(dep_room_ints))
-            od_total = result.get('manual_od', len(od_room_ints))
-            
             sheet.cell(row=38, column=7, value=ea_total)  # G38: EA total
             sheet.cell(row=38, column=9, value=do_total)  # I38: DO total
             sheet.cell(row=38, column=11, value=od_total)  # K38: OD total
@@ -569,19 +773,40 @@ def create_excel_output(result, schedule_date):
             print(f"Error adding totals: {e}")
         
         # Save the updated Excel
+        _remove_for_write(output_path)
         wb.save(output_path)
         
+        _link_or_copy(output_path, cached_xlsx)
+        _evict_image_cache(cache_dir)
+        
         return output_path
         
     except Exception as e:
         print(f"Error creating Excel: {e}")
-        import traceback
         traceback.print_exc()
         return None
 
+# Một session keep-alive cho mọi call ComPDF - token, upload, execute, polling
+# và download dùng lại cùng kết nối TLS thay vì handshake mỗi lần
+_COMPDF_SESSION = requests.Session()
+# Connection that dropped/failed before the request was sent is retried on a fresh one
+# (read/status retries off - execute/upload must not run twice)
+_COMPDF_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4,
+                                              max_retries=Retry(total=2, read=0, status=0, backoff_factor=0.2)))
+COMPDF_TIMEOUT = (5, 30)  # (connect, read)
+COMPDF_TRANSFER_TIMEOUT = (5, 60)  # upload/download file
+
+# Token và executeTypeUrl (xlsx->pdf) của ComPDF dùng lại giữa các request đến khi hết hạn
+COMPDF_TOKEN_TTL = 3600  # seconds, when the token response has no expiresIn
+_COMPDF_TOKEN = {'value': None, 'exp': 0.0}
+_COMPDF_EXECUTE_TYPE_URL = None
+_COMPDF_LOCK = threading.Lock()
+
 def get_compdf_access_token():
-    """Get access token from ComPDF API"""
-    import requests
+    """Get access token from ComPDF API (cached until shortly before it expires)"""
+    with _COMPDF_LOCK:
+        if _COMPDF_TOKEN['value'] and time.time() < _COMPDF_TOKEN['exp'] - 60:
+            return _COMPDF_TOKEN['value']
     
     PUBLIC_KEY = os.environ.get('COMPDF_PUBLIC_KEY')
     SECRET_KEY = os.environ.get('COMPDF_SECRET_KEY')
@@ -602,12 +827,20 @@ def get_compdf_access_token():
             "Content-Type": "application/json"
         }
         
-        response = requests.post(token_url, json=data, headers=headers, timeout=30)
+        response = _COMPDF_SESSION.post(token_url, json=data, headers=headers, timeout=COMPDF_TIMEOUT)
         
         if response.status_code == 200:
             result = response.json()
             if 'data' in result and 'accessToken' in result['data']:
-                return result['data']['accessToken']
+                token_data = result['data']
+                try:
+                    expires_in = float(token_data.get('expiresIn') or COMPDF_TOKEN_TTL)
+                except (TypeError, ValueError):
+                    expires_in = COMPDF_TOKEN_TTL
+                with _COMPDF_LOCK:
+                    _COMPDF_TOKEN['value'] = token_data['accessToken']
+                    _COMPDF_TOKEN['exp'] = time.time() + expires_in
+                return token_data['accessToken']
         
         print(f"Failed to get access token: {response.text}")
         return None
@@ -616,30 +849,27 @@ def get_compdf_access_token():
         print(f"Error getting access token: {e}")
         return None
 
-def convert_excel_to_pdf_via_compdf(excel_path):
-    """Convert Excel to PDF using ComPDF API with correct workflow from documentation"""
-    import requests
-    import json
-    import time
-    
-    # Get access token
-    access_token = get_compdf_access_token()
-    if not access_token:
-        print("Could not get ComPDF access token")
-        return None
+def _clear_compdf_token():
+    """Bỏ token đã cache (ComPDF trả 401/403 - hết hạn/bị thu hồi sớm), lần sau lấy token mới"""
+    with _COMPDF_LOCK:
+        _COMPDF_TOKEN['value'] = None
+
+def get_compdf_execute_type_url(headers):
+    """Tìm executeTypeUrl Excel -> PDF trong danh sách tool của ComPDF (cache sau lần đầu)"""
+    global _COMPDF_EXECUTE_TYPE_URL
+    if _COMPDF_EXECUTE_TYPE_URL:
+        return _COMPDF_EXECUTE_TYPE_URL
     
     try:
-        headers = {
-            "Authorization": f"Bearer {access_token}"
-        }
-        
         # Step 1: Get tool support list to find the correct executeTypeUrl
         print("Getting ComPDF tool support list...")
         tools_url = "https://api-server.compdf.com/server/v1/tool/support"
-        tools_response = requests.get(tools_url, headers=headers, timeout=30)
+        tools_response = _COMPDF_SESSION.get(tools_url, headers=headers, timeout=COMPDF_TIMEOUT)
         
         if tools_response.status_code != 200:
             print(f"Failed to get tool support: {tools_response.text}")
+            if tools_response.status_code in (401, 403):
+                _clear_compdf_token()
             return None
             
         tools_result = tools_response.json()
@@ -675,16 +905,48 @@ def convert_excel_to_pdf_via_compdf(excel_path):
             print("Could not find Excel to PDF conversion tool in supported tools")
             print(f"Available tools: {[tool.get('executeTypeUrl') for tool in tools_result.get('data', [])[:10]]}")
             return None
+        
+        _COMPDF_EXECUTE_TYPE_URL = execute_type_url
+        return execute_type_url
+        
+    except Exception as e:
+        print(f"Error getting tool support: {e}")
+        return None
+
+def convert_excel_to_pdf_via_compdf(excel_path):
+    """Convert Excel to PDF using ComPDF API with correct workflow from documentation"""
+    try:
+        # Step 1: Find the executeTypeUrl for Excel -> PDF (cached after the first lookup).
+        # A cached token the lookup rejects (401/403) is dropped - retry once with a fresh one
+        for attempt in range(2):
+            # Get access token
+            access_token = get_compdf_access_token()
+            if not access_token:
+                print("Could not get ComPDF access token")
+                return None
+            
+            headers = {
+                "Authorization": f"Bearer {access_token}"
+            }
+            
+            execute_type_url = get_compdf_execute_type_url(headers)
+            if execute_type_url or _COMPDF_TOKEN['value'] is not None:
+                break
+        if not execute_type_url:
+            return None
             
         print(f"Using executeTypeUrl: {execute_type_url}")
         
         # Step 2: Create task using GET with executeTypeUrl as path parameter
         print("Creating ComPDF conversion task...")
         create_task_url = f"https://api-server.compdf.com/server/v1/task/{execute_type_url}?language=1"
-        create_response = requests.get(create_task_url, headers=headers, timeout=30)
+        create_response = _COMPDF_SESSION.get(create_task_url, headers=headers, timeout=COMPDF_TIMEOUT)
         
         if create_response.status_code != 200:
             print(f"Failed to create task: {create_response.text}")
+            if create_response.status_code in (401, 403):
+                # Cached token was revoked/expired early - fetch a new one next time
+                _clear_compdf_token()
             return None
             
         create_result = create_response.json()
@@ -711,7 +973,7 @@ def convert_excel_to_pdf_via_compdf(excel_path):
             }
             
             print("Uploading Excel file...")
-            upload_response = requests.post(upload_url, headers=upload_headers, files=files, data=upload_data, timeout=60)
+            upload_response = _COMPDF_SESSION.post(upload_url, headers=upload_headers, files=files, data=upload_data, timeout=COMPDF_TRANSFER_TIMEOUT)
         
         if upload_response.status_code != 200:
             print(f"Failed to upload file: {upload_response.text}")
@@ -732,7 +994,7 @@ def convert_excel_to_pdf_via_compdf(excel_path):
             "Authorization": f"Bearer {access_token}"
         }
         
-        execute_response = requests.get(execute_url, headers=execute_headers, timeout=30)
+        execute_response = _COMPDF_SESSION.get(execute_url, headers=execute_headers, timeout=COMPDF_TIMEOUT)
         
         if execute_response.status_code != 200:
             print(f"Failed to execute conversion: {execute_response.text}")
@@ -746,9 +1008,12 @@ def convert_excel_to_pdf_via_compdf(excel_path):
         print("Conversion started, waiting for completion...")
         
         # Step 4: Check status and download
-        max_attempts = 30  # Wait up to 5 minutes
+        # Exponential backoff 1s, 2s, 4s, 8s, then 10s between checks (~4.5 minutes max)
+        max_attempts = 30
+        delay = 1.0
         for attempt in range(max_attempts):
-            time.sleep(10)  # Wait 10 seconds between checks
+            time.sleep(delay)
+            delay = min(delay * 2, 10.0)
             
             print(f"Checking status... (attempt {attempt + 1}/{max_attempts})")
             
@@ -758,7 +1023,7 @@ def convert_excel_to_pdf_via_compdf(excel_path):
                 "Authorization": f"Bearer {access_token}"
             }
             
-            status_response = requests.get(status_url, headers=status_headers, timeout=30)
+            status_response = _COMPDF_SESSION.get(status_url, headers=status_headers, timeout=COMPDF_TIMEOUT)
             
             if status_response.status_code != 200:
                 print(f"Failed to check status: {status_response.text}")
@@ -782,7 +1047,7 @@ def convert_excel_to_pdf_via_compdf(excel_path):
                     
                 print(f"Downloading PDF from: {download_url}")
                 
-                download_response = requests.get(download_url, timeout=60)
+                download_response = _COMPDF_SESSION.get(download_url, timeout=COMPDF_TRANSFER_TIMEOUT)
                 if download_response.status_code == 200:
                     return download_response.content
                 else:
@@ -802,64 +1067,178 @@ def convert_excel_to_pdf_via_compdf(excel_path):
         
     except Exception as e:
         print(f"ComPDF API error: {e}")
-        import traceback
         traceback.print_exc()
         return None
 
+def convert_excel_to_pdf_via_unoserver(excel_path):
+    """Convert Excel to PDF qua unoserver đang chạy (unoconvert), returns PDF bytes"""
+    try:
+        # Output '-' = PDF bytes on stdout, no temp dir
+        cmd = [UNOCONVERT_PATH, '--convert-to', 'pdf', excel_path, '-']
+        result = subprocess.run(cmd, capture_output=True, timeout=60)
+        if result.returncode != 0 or not result.stdout:
+            print(f"unoconvert failed: {result.stderr.decode('utf-8', errors='replace')}")
+            return None
+        return result.stdout
+    
+    except subprocess.TimeoutExpired:
+        print("unoconvert timed out (>60s)")
+        return None
+    except Exception as e:
+        print(f"unoconvert error: {e}")
+        return None
+
+def convert_excel_to_pdf_via_libreoffice(excel_path):
+    """Convert Excel to PDF locally with headless LibreOffice, returns PDF bytes"""
+    if UNOCONVERT_PATH:
+        pdf_data = convert_excel_to_pdf_via_unoserver(excel_path)
+        if pdf_data:
+            return pdf_data
+    
+    if not SOFFICE_PATH:
+        return None
+    
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cmd = [SOFFICE_PATH, '--headless', '--convert-to', 'pdf', '--outdir', temp_dir, excel_path]
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            
+            pdf_path = os.path.join(temp_dir, os.path.splitext(os.path.basename(excel_path))[0] + '.pdf')
+            if result.returncode != 0 or not os.path.exists(pdf_path):
+                print(f"LibreOffice conversion failed: {result.stderr}")
+                return None
+            
+            with open(pdf_path, 'rb') as f:
+                return f.read()
+    
+    except subprocess.TimeoutExpired:
+        print("LibreOffice conversion timed out (>60s)")
+        return None
+    except Exception as e:
+        print(f"LibreOffice conversion error: {e}")
+        return None
+
+def _content_crop(page, padding):
+    """Phần lề trắng cắt bỏ (left, bottom, right, top) theo bbox vector của nội dung trang"""
+    page_left, page_bottom, page_right, page_top = page.get_bbox()
+    bounds = [obj.get_bounds() if hasattr(obj, 'get_bounds') else obj.get_pos()
+              for obj in page.get_objects()]
+    if not bounds:
+        return (0, 0, 0, 0)
+    left = min(b[0] for b in bounds) - padding
+    bottom = min(b[1] for b in bounds) - padding
+    right = max(b[2] for b in bounds) + padding
+    top = max(b[3] for b in bounds) + padding
+    return (max(0, left - page_left), max(0, bottom - page_bottom),
+            max(0, page_right - right), max(0, page_top - top))
+
+def _excel_content_key(excel_path):
+    """Hash nội dung workbook (bỏ docProps - chứa thời điểm lưu) + thông số render ảnh"""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f'dpi={PREVIEW_DPI};padding={PREVIEW_PADDING}'.encode())
+    with zipfile.ZipFile(excel_path) as zf:
+        for name in sorted(zf.namelist()):
+            if name.startswith('docProps/'):
+                continue
+            hasher.update(name.encode())
+            hasher.update(zf.read(name))
+    return hasher.hexdigest()
+
+def _evict_image_cache(cache_dir):
+    """Xoá file cache ít dùng nhất (theo atime) khi thư mục cache vượt IMAGE_CACHE_MAX_BYTES"""
+    entries = [(entry.path, entry.stat()) for entry in os.scandir(cache_dir) if entry.is_file()]
+    total = sum(stat.st_size for _, stat in entries)
+    for path, stat in sorted(entries, key=lambda item: item[1].st_atime):
+        if total <= IMAGE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= stat.st_size
+        except OSError:
+            pass
+
 def create_image_from_excel(excel_path):
-    """Tạo ảnh từ file Excel sử dụng ComPDF API"""
+    """Tạo ảnh từ file Excel - LibreOffice trên máy nếu có, không thì ComPDF API"""
     try:
         image_path = excel_path.replace('.xlsx', '.png')
         
-        # Step 1: Convert Excel to PDF using ComPDF API
-        print("Converting Excel to PDF using ComPDF API...")
-        pdf_data = convert_excel_to_pdf_via_compdf(excel_path)
+        # Same workbook content (retry, unchanged manual edit) -> reuse the cached PNG,
+        # or at least the cached PDF so ComPDF/LibreOffice is not called again
+        cache_dir = os.path.join(app.config['UPLOAD_FOLDER'], IMAGE_CACHE_DIRNAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_key = _excel_content_key(excel_path)
+        cached_png = os.path.join(cache_dir, f'{cache_key}.png')
+        cached_pdf = os.path.join(cache_dir, f'{cache_key}.pdf')
+        
+        if os.path.exists(cached_png):
+            _touch_cache_entry(cached_png)
+            _link_or_copy(cached_png, image_path)
+            print(f"Image reused from cache: {image_path}")
+            return image_path
+        
+        # Step 1: Convert Excel to PDF - local LibreOffice first, no network round-trip
+        pdf_data = None
+        if os.path.exists(cached_pdf):
+            _touch_cache_entry(cached_pdf)
+            with open(cached_pdf, 'rb') as f:
+                pdf_data = f.read()
+            print("PDF reused from cache")
+        
+        if not pdf_data and (UNOCONVERT_PATH or SOFFICE_PATH):
+            print(f"Converting Excel to PDF using LibreOffice ({UNOCONVERT_PATH or SOFFICE_PATH})...")
+            pdf_data = convert_excel_to_pdf_via_libreoffice(excel_path)
+        
+        if not pdf_data:
+            print("Converting Excel to PDF using ComPDF API...")
+            pdf_data = convert_excel_to_pdf_via_compdf(excel_path)
         
         if not pdf_data:
             print("Failed to convert Excel to PDF via ComPDF API")
             return None
+        
+        if not os.path.exists(cached_pdf):
+            _write_atomic(cached_pdf, pdf_data)
             
-        # Step 2: Save PDF temporarily and convert to PNG
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_pdf_path = os.path.join(temp_dir, 'converted.pdf')
-            
-            # Write PDF data to temporary file
-            with open(temp_pdf_path, 'wb') as f:
-                f.write(pdf_data)
-                
-            print(f"PDF saved to {temp_pdf_path}, converting to image...")
-            
-            # Step 3: Convert PDF to PNG using pdf2image
-            images = convert_from_path(temp_pdf_path, dpi=200, fmt='PNG', first_page=1, last_page=1)
-            
-            if not images:
-                print("Failed to convert PDF to image")
-                return None
-                
-            image = images[0]
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-                
-            # Crop whitespace
-            bbox = image.getbbox()
-            if bbox:
-                padding = 20
-                left, top, right, bottom = bbox
-                left = max(0, left - padding)
-                top = max(0, top - padding)  
-                right = min(image.width, right + padding)
-                bottom = min(image.height, bottom + padding)
-                
-                image = image.crop((left, top, right, bottom))
-            
-            image.save(image_path, 'PNG', quality=95, optimize=True)
-            print(f"Image saved to {image_path}")
-            
-            return image_path
+        # Step 2: Render page 1 to PNG in-process with PDFium, straight from the PDF bytes
+        print("Rendering PDF to image...")
+        try:
+            # Same PDFium lock as the pdf_to_text fallback - another request may be using it
+            with _PDFIUM_LOCK:
+                pdf = pdfium.PdfDocument(pdf_data)
+                try:
+                    if len(pdf) == 0:
+                        raise ValueError("PDF has no pages")
+                    # 120 DPI is enough for an on-screen preview - ~1/3 of the pixels of 200 DPI
+                    scale = PREVIEW_DPI / 72
+                    page = pdf[0]
+                    # Crop whitespace (PREVIEW_PADDING px) from the vector content bounds, so the
+                    # renderer never rasterizes the empty margins and no pixel sweep is needed
+                    image = page.render(scale=scale, crop=_content_crop(page, PREVIEW_PADDING / scale)).to_pil()
+                finally:
+                    pdf.close()
+        except Exception:
+            # A PDF that cannot be rendered must not stay cached - convert again next time
+            try:
+                os.remove(cached_pdf)
+            except OSError:
+                pass
+            raise
+        
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        
+        # PNG ignores quality; fast zlib level instead of the extra optimize pass
+        _remove_for_write(image_path)
+        image.save(image_path, 'PNG', compress_level=1)
+        print(f"Image saved to {image_path}")
+        
+        _link_or_copy(image_path, cached_png)
+        _evict_image_cache(cache_dir)
+        
+        return image_path
             
     except Exception as e:
         print(f"Error creating image: {e}")
-        import traceback
         traceback.print_exc()
         return None
 
@@ -869,7 +1248,9 @@ def download_file(filename):
     try:
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True)
+            # ETag/Last-Modified -> 304 on re-download; max_age=0 makes the browser
+            # revalidate every time since the file is regenerated under the same name
+            return send_file(file_path, as_attachment=True, conditional=True, etag=True, max_age=0)
         else:
             return jsonify({'error': 'File not found'}), 404
     except Exception as e:
@@ -881,7 +1262,8 @@ def preview_file(filename):
     try:
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         if os.path.exists(file_path) and filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-            return send_file(file_path, as_attachment=False)
+            # Same validators as download_file - an unchanged preview is answered with 304
+            return send_file(file_path, as_attachment=False, conditional=True, etag=True, max_age=0)
         else:
             return jsonify({'error': 'Image file not found'}), 404
     except Exception as e:
@@ -952,24 +1334,15 @@ def test_base64_upload():
         # Process ARR base64
         if arr_b64:
             try:
-                import base64
                 pdf_data = base64.b64decode(arr_b64)
                 print(f"📄 Decoded ARR PDF: {len(pdf_data)} bytes")
                 
-                # Save temporarily
-                temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_arr_b64.pdf')
-                with open(temp_path, 'wb') as f:
-                    f.write(pdf_data)
-                
-                # Extract rooms
-                arr_rooms = extract_rooms_from_arr_dep(temp_path)
+                # Extract rooms straight from the decoded bytes
+                arr_rooms = extract_rooms_from_arr_dep(pdf_data)
                 result['ARR'] = arr_rooms
                 result['processing_info'].append(f"ARR B64: {len(arr_rooms)} phòng")
                 print(f"✅ ARR B64 processing: {len(arr_rooms)} rooms")
                 
-                # Clean up
-                os.remove(temp_path)
-                
             except Exception as e:
                 print(f"❌ ARR B64 error: {e}")
                 result['processing_info'].append(f"❌ Lỗi ARR B64: {str(e)}")
@@ -977,24 +1350,15 @@ def test_base64_upload():
         # Process DEP base64
         if dep_b64:
             try:
-                import base64
                 pdf_data = base64.b64decode(dep_b64)
                 print(f"📄 Decoded DEP PDF: {len(pdf_data)} bytes")
                 
-                # Save temporarily
-                temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_dep_b64.pdf')
-                with open(temp_path, 'wb') as f:
-                    f.write(pdf_data)
-                
-                # Extract rooms
-                dep_rooms = extract_rooms_from_arr_dep(temp_path)
+                # Extract rooms straight from the decoded bytes
+                dep_rooms = extract_rooms_from_arr_dep(pdf_data)
                 result['DEP'] = dep_rooms
                 result['processing_info'].append(f"DEP B64: {len(dep_rooms)} phòng")
                 print(f"✅ DEP B64 processing: {len(dep_rooms)} rooms")
                 
-                # Clean up
-                os.remove(temp_path)
-                
             except Exception as e:
                 print(f"❌ DEP B64 error: {e}")
                 result['processing_info'].append(f"❌ Lỗi DEP B64: {str(e)}")
@@ -1019,7 +1383,6 @@ def test_base64_upload():
         
     except Exception as e:
         print(f"\n❌ B64 TEST ERROR: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': f'Base64 test error: {str(e)}'}), 500
 
@@ -1048,9 +1411,10 @@ def manual_edit():
             od_rooms_str = request.form.get('od_rooms', '').strip()
             
             # Parse room lists
-            arr_rooms = [room.strip() for room in arr_rooms_str.split(',') if room.strip()] if arr_rooms_str else []
-            dep_rooms = [room.strip() for room in dep_rooms_str.split(',') if room.strip()] if dep_rooms_str else []
-            od_rooms = [room.strip() for room in od_rooms_str.split(',') if room.strip()] if od_rooms_str else []
+            # Same items as split(',') + strip() + dropping empties, in one C-level pass
+            arr_rooms = _ROOM_LIST_RE.findall(arr_rooms_str)
+            dep_rooms = _ROOM_LIST_RE.findall(dep_rooms_str)
+            od_rooms = _ROOM_LIST_RE.findall(od_rooms_str)
             
             # Get manual totals (if provided)
             manual_ea = request.form.get('manual_ea', '').strip()
@@ -1066,15 +1430,15 @@ def manual_edit():
             }
             
             # Add manual totals if provided
-            if manual_ea and manual_ea.isdigit():
+            if manual_ea.isdecimal():
                 result['manual_ea'] = int(manual_ea)
                 result['processing_info'].append(f'Manual EA total: {manual_ea}')
             
-            if manual_do and manual_do.isdigit():
+            if manual_do.isdecimal():
                 result['manual_do'] = int(manual_do)
                 result['processing_info'].append(f'Manual DO total: {manual_do}')
             
-            if manual_od and manual_od.isdigit():
+            if manual_od.isdecimal():
                 result['manual_od'] = int(manual_od)
                 result['processing_info'].append(f'Manual OD total: {manual_od}')
             
@@ -1107,26 +1471,28 @@ def upload_files():
     if request.method == 'OPTIONS':
         return '', 200
         
-    print("\n🚀 === UPLOAD REQUEST RECEIVED ===")
-    print(f"Request method: {request.method}")
-    print(f"Content-Type: {request.content_type}")
-    print(f"Content-Length: {request.headers.get('Content-Length', 'Unknown')}")
-    print(f"User-Agent: {request.headers.get('User-Agent', 'Unknown')[:100]}...")
-    print(f"Form data keys: {list(request.form.keys())}")
-    print(f"Files: {list(request.files.keys())}")
-    
-    # Log total request size
-    total_size = 0
-    for file_key in request.files:
-        files = request.files.getlist(file_key)
-        for file in files:
-            if file.filename:
-                file_content = file.read()
-                total_size += len(file_content)
-                file.seek(0)  # Reset file pointer
-                print(f"📁 File {file.filename}: {len(file_content)} bytes ({len(file_content)/1024/1024:.2f}MB)")
-    
-    print(f"📊 Total upload size: {total_size} bytes ({total_size/1024/1024:.2f}MB)")
+    # Request diagnostics: debug level, %-args so nothing is formatted (nor files sized) in production
+    log = app.logger
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("🚀 === UPLOAD REQUEST RECEIVED ===")
+        log.debug("Request method: %s", request.method)
+        log.debug("Content-Type: %s", request.content_type)
+        log.debug("Content-Length: %s", request.headers.get('Content-Length', 'Unknown'))
+        log.debug("User-Agent: %s...", request.headers.get('User-Agent', 'Unknown')[:100])
+        log.debug("Form data keys: %s", list(request.form.keys()))
+        log.debug("Files: %s", list(request.files.keys()))
+        
+        # Log total request size
+        total_size = 0
+        for file_key in request.files:
+            files = request.files.getlist(file_key)
+            for file in files:
+                if file.filename:
+                    file_size = _upload_size(file)
+                    total_size += file_size
+                    log.debug("📁 File %s: %d bytes (%.2fMB)", file.filename, file_size, file_size / 1024 / 1024)
+        
+        log.debug("📊 Total upload size: %d bytes (%.2fMB)", total_size, total_size / 1024 / 1024)
     
     try:
         schedule_date = request.form.get('schedule_date', '')
@@ -1160,120 +1526,140 @@ def upload_files():
             'processing_info': []
         }
         
-        # Process ARR file
-        if 'arr_file' in request.files:
-            arr_file = request.files['arr_file']
-            if arr_file and arr_file.filename and allowed_file(arr_file.filename):
-                filename = secure_filename(arr_file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'arr_' + filename)
+        # Read the uploaded PDFs into memory (GIH images still go to temp files for OCR),
+        # then extract ARR, DEP and GIH concurrently - the three files are independent
+        saved_files = []
+        arr_job = dep_job = gih_job = None
+        
+        try:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                # Process ARR file
+                if 'arr_file' in request.files:
+                    arr_file = request.files['arr_file']
+                    if arr_file and arr_file.filename and allowed_file(arr_file.filename):
+                        filename = secure_filename(arr_file.filename)
+                        
+                        print(f"📥 Processing ARR file: {filename} (size: {_upload_size(arr_file)} bytes)")
+                        
+                        try:
+                            pdf_data, digest = _read_upload(arr_file)
+                            arr_job = (executor.submit(_cached_extract, ('ARR/DEP', digest),
+                                                       extract_rooms_from_arr_dep, pdf_data), filename)
+                        except Exception as e:
+                            print(f"❌ Error processing ARR file {filename}: {e}")
+                            result['processing_info'].append(f"❌ Lỗi ARR: {str(e)}")
                 
-                print(f"📥 Processing ARR file: {filename} (size: {len(arr_file.read())} bytes)")
-                arr_file.seek(0)  # Reset file pointer after reading size
+                # Process DEP file
+                if 'dep_file' in request.files:
+                    dep_file = request.files['dep_file']
+                    if dep_file and dep_file.filename and allowed_file(dep_file.filename):
+                        filename = secure_filename(dep_file.filename)
+                        
+                        print(f"📥 Processing DEP file: {filename} (size: {_upload_size(dep_file)} bytes)")
+                        
+                        try:
+                            pdf_data, digest = _read_upload(dep_file)
+                            dep_job = (executor.submit(_cached_extract, ('ARR/DEP', digest),
+                                                       extract_rooms_from_arr_dep, pdf_data), filename)
+                        except Exception as e:
+                            print(f"❌ Error processing DEP file {filename}: {e}")
+                            result['processing_info'].append(f"❌ Lỗi DEP: {str(e)}")
                 
-                try:
-                    arr_file.save(filepath)
-                    print(f"📁 ARR file saved to: {filepath}")
+                # Process GIH files (PDF or multiple images)
+                if 'gih_file' in request.files:
+                    gih_files = request.files.getlist('gih_file')  # Get all files with this name
                     
-                    arr_rooms = extract_rooms_from_arr_dep(filepath)
-                    result['ARR'] = arr_rooms
-                    result['processing_info'].append(f"ARR: {len(arr_rooms)} phòng từ {filename}")
-                    print(f"✅ ARR processing complete: {len(arr_rooms)} rooms found")
-                    
-                except Exception as e:
-                    print(f"❌ Error processing ARR file {filename}: {e}")
-                    result['processing_info'].append(f"❌ Lỗi ARR: {str(e)}")
-                finally:
-                    if os.path.exists(filepath):
-                        os.remove(filepath)  # Clean up
-                        print(f"🗑️ Cleaned up ARR file: {filepath}")
-        
-        # Process DEP file
-        if 'dep_file' in request.files:
-            dep_file = request.files['dep_file']
-            if dep_file and dep_file.filename and allowed_file(dep_file.filename):
-                filename = secure_filename(dep_file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'dep_' + filename)
-                
-                print(f"📥 Processing DEP file: {filename} (size: {len(dep_file.read())} bytes)")
-                dep_file.seek(0)  # Reset file pointer after reading size
+                    if gih_files and gih_files[0].filename:  # At least one file exists
+                        # Check if it's a single PDF file
+                        if len(gih_files) == 1 and allowed_file(gih_files[0].filename):
+                            # Single PDF file
+                            gih_file = gih_files[0]
+                            filename = secure_filename(gih_file.filename)
+                            
+                            try:
+                                pdf_data, digest = _read_upload(gih_file)
+                                gih_job = ('pdf', executor.submit(_cached_extract, ('GIH', digest, schedule_date),
+                                                                  extract_rooms_from_gih, pdf_data, schedule_date), filename)
+                            except Exception as e:
+                                print(f"❌ Error processing GIH file {filename}: {e}")
+                                result['processing_info'].append(f"❌ Lỗi GIH: {str(e)}")
+                            
+                        else:
+                            # Multiple image files or single image file
+                            image_paths = []
+                            
+                            try:
+                                for i, gih_file in enumerate(gih_files):
+                                    if gih_file.filename and allowed_image_file(gih_file.filename):
+                                        extension = os.path.splitext(gih_file.filename)[1].lower()
+                                        filepath = _save_upload_to_temp(gih_file, f'gih_{i}_', extension)
+                                        saved_files.append(filepath)
+                                        image_paths.append(filepath)
+                                
+                                if image_paths:
+                                    print(f"📸 Processing {len(image_paths)} GIH image files with enhanced OCR...")
+                                    gih_job = ('images', executor.submit(extract_rooms_from_gih_images, image_paths, schedule_date), image_paths)
+                                else:
+                                    result['processing_info'].append(f"Không tìm thấy ảnh GIH hợp lệ trong {len(gih_files)} files")
+                                    
+                            except Exception as e:
+                                print(f"Error processing GIH image files: {e}")
+                                result['processing_info'].append(f"Lỗi xử lý ảnh GIH: {str(e)}")
                 
-                try:
-                    dep_file.save(filepath)
-                    print(f"📁 DEP file saved to: {filepath}")
-                    
-                    dep_rooms = extract_rooms_from_arr_dep(filepath)
-                    result['DEP'] = dep_rooms
-                    result['processing_info'].append(f"DEP: {len(dep_rooms)} phòng từ {filename}")
-                    print(f"✅ DEP processing complete: {len(dep_rooms)} rooms found")
-                    
-                except Exception as e:
-                    print(f"❌ Error processing DEP file {filename}: {e}")
-                    result['processing_info'].append(f"❌ Lỗi DEP: {str(e)}")
-                finally:
-                    if os.path.exists(filepath):
-                        os.remove(filepath)  # Clean up
-                        print(f"🗑️ Cleaned up DEP file: {filepath}")
-        
-        # Process GIH files (PDF or multiple images)
-        if 'gih_file' in request.files:
-            gih_files = request.files.getlist('gih_file')  # Get all files with this name
-            
-            if gih_files and gih_files[0].filename:  # At least one file exists
-                gih_result = {'ARR': [], 'OD': []}
+                # Collect results in ARR, DEP, GIH order
+                if arr_job:
+                    arr_future, filename = arr_job
+                    try:
+                        arr_rooms = arr_future.result()
+                        result['ARR'] = arr_rooms
+                        result['processing_info'].append(f"ARR: {len(arr_rooms)} phòng từ {filename}")
+                        print(f"✅ ARR processing complete: {len(arr_rooms)} rooms found")
+                    except Exception as e:
+                        print(f"❌ Error processing ARR file {filename}: {e}")
+                        result['processing_info'].append(f"❌ Lỗi ARR: {str(e)}")
                 
-                # Check if it's a single PDF file
-                if len(gih_files) == 1 and allowed_file(gih_files[0].filename):
-                    # Single PDF file
-                    gih_file = gih_files[0]
-                    filename = secure_filename(gih_file.filename)
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'gih_' + filename)
-                    gih_file.save(filepath)
-                    
-                    gih_result = extract_rooms_from_gih(filepath, schedule_date)
-                    result['processing_info'].append(f"GIH PDF: {len(gih_result['OD'])} OD phòng, {len(gih_result['ARR'])} thêm vào ARR từ {filename}")
-                    
-                    os.remove(filepath)  # Clean up
-                    
-                else:
-                    # Multiple image files or single image file
-                    image_paths = []
-                    saved_files = []
-                    
+                if dep_job:
+                    dep_future, filename = dep_job
                     try:
-                        for i, gih_file in enumerate(gih_files):
-                            if gih_file.filename and allowed_image_file(gih_file.filename):
-                                filename = secure_filename(gih_file.filename)
-                                filepath = os.path.join(app.config['UPLOAD_FOLDER'], f'gih_{i}_{filename}')
-                                gih_file.save(filepath)
-                                image_paths.append(filepath)
-                                saved_files.append(filepath)
-                        
-                        if image_paths:
-                            print(f"📸 Processing {len(image_paths)} GIH image files with enhanced OCR...")
-                            gih_result = extract_rooms_from_gih_images(image_paths, schedule_date)
-                            result['processing_info'].append(f"🏨 GIH Enhanced: {len(image_paths)} ảnh, {len(gih_result['OD'])} OD phòng, {len(gih_result['ARR'])} ARR phòng (với sửa lỗi OCR thông minh)")
-                        else:
-                            result['processing_info'].append(f"Không tìm thấy ảnh GIH hợp lệ trong {len(gih_files)} files")
-                            
+                        dep_rooms = dep_future.result()
+                        result['DEP'] = dep_rooms
+                        result['processing_info'].append(f"DEP: {len(dep_rooms)} phòng từ {filename}")
+                        print(f"✅ DEP processing complete: {len(dep_rooms)} rooms found")
                     except Exception as e:
-                        print(f"Error processing GIH image files: {e}")
-                        result['processing_info'].append(f"Lỗi xử lý ảnh GIH: {str(e)}")
-                        
-                    finally:
-                        # Clean up saved image files
-                        for filepath in saved_files:
-                            try:
-                                os.remove(filepath)
-                            except:
-                                pass
+                        print(f"❌ Error processing DEP file {filename}: {e}")
+                        result['processing_info'].append(f"❌ Lỗi DEP: {str(e)}")
                 
-                # Merge ARR from GIH with ARR from file
-                if gih_result['ARR'] or gih_result['OD']:
-                    combined_arr = list(set(result['ARR'] + gih_result['ARR']))
-                    combined_arr.sort()
-                    result['ARR'] = combined_arr
+                if gih_job:
+                    gih_kind, gih_future, gih_source = gih_job
+                    gih_result = {'ARR': [], 'OD': []}
+                    if gih_kind == 'pdf':
+                        try:
+                            gih_result = gih_future.result()
+                            result['processing_info'].append(f"GIH PDF: {len(gih_result['OD'])} OD phòng, {len(gih_result['ARR'])} thêm vào ARR từ {gih_source}")
+                        except Exception as e:
+                            print(f"❌ Error processing GIH file {gih_source}: {e}")
+                            result['processing_info'].append(f"❌ Lỗi GIH: {str(e)}")
+                    else:
+                        try:
+                            gih_result = gih_future.result()
+                            result['processing_info'].append(f"🏨 GIH Enhanced: {len(gih_source)} ảnh, {len(gih_result['OD'])} OD phòng, {len(gih_result['ARR'])} ARR phòng (với sửa lỗi OCR thông minh)")
+                        except Exception as e:
+                            print(f"Error processing GIH image files: {e}")
+                            result['processing_info'].append(f"Lỗi xử lý ảnh GIH: {str(e)}")
                     
-                    result['OD'] = gih_result['OD']
+                    # Merge ARR from GIH with ARR from file
+                    if gih_result['ARR'] or gih_result['OD']:
+                        result['ARR'] = sorted(set(result['ARR']).union(gih_result['ARR']))
+                        
+                        result['OD'] = gih_result['OD']
+        finally:
+            # Clean up saved upload files
+            for filepath in saved_files:
+                try:
+                    os.remove(filepath)
+                    print(f"🗑️ Cleaned up upload file: {filepath}")
+                except OSError:
+                    pass
         
         # Create Excel file with results
         excel_path = create_excel_output(result, schedule_date)
@@ -1304,7 +1690,6 @@ def upload_files():
     except Exception as e:
         print(f"\n❌ === UPLOAD ERROR ===")
         print(f"Error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': f'Lỗi xử lý: {str(e)}'}), 500
 